@@ -1,13 +1,27 @@
 """
 YouTube MP3 Downloader - Blueprint version for integration with main website
 """
-from flask import Blueprint, render_template, request, jsonify, send_file, send_from_directory
+from flask import Blueprint, Response, render_template, request, jsonify, send_from_directory
 import os
 import uuid
 import threading
-import queue
 import subprocess
 import time
+import json
+import shutil
+import re
+import sys
+import zipfile
+import atexit
+import socket
+import errno
+from itertools import islice
+from collections import deque, OrderedDict
+from urllib.parse import urlparse, parse_qs
+from shared.metrics import Counter, Histogram, STAGE_BUCKETS
+from shared.files import ExpiryScheduler, ZipStream, ARCHIVE_CHUNK_SIZE, X_ACCEL_REDIRECT, attachment_header, serve_held, count_served
+from shared.state import DATA_DIR, MemoryStore, SQLiteStore
+from shared.responses import long_responses, busy_response
 
 # Get absolute paths
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -21,209 +35,1585 @@ youtube_bp = Blueprint('youtube_mp3', __name__,
 # Configuration - use absolute paths
 DOWNLOAD_FOLDER = os.path.join(APP_DIR, 'downloads')
 TEMP_FOLDER = os.path.join(APP_DIR, 'temp_downloads')
+CACHE_FOLDER = os.path.join(APP_DIR, 'cache')
+SOURCE_FOLDER = os.path.join(APP_DIR, 'source_cache')
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 os.makedirs(TEMP_FOLDER, exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+os.makedirs(SOURCE_FOLDER, exist_ok=True)
+
+# Worker pool configuration
+WORKER_COUNT = int(os.environ.get('MUSIC_WORKERS', '4'))  # Tasks processed at once
+SOURCE_LIMITS = {  # Max concurrent tasks per source
+    'youtube': int(os.environ.get('MUSIC_YOUTUBE_SLOTS', '3')),
+    'spotify': int(os.environ.get('MUSIC_SPOTIFY_SLOTS', '1')),
+}
+FFMPEG_THREADS = int(os.environ.get('MUSIC_FFMPEG_THREADS', '1'))  # ffmpeg threads per task
+SPOTIFY_THREADS = int(os.environ.get('MUSIC_SPOTIFY_THREADS', '4'))  # Tracks spotdl downloads at once per task
+PLAYLIST_PARALLEL = int(os.environ.get('MUSIC_PLAYLIST_PARALLEL', '2'))  # Videos of one playlist downloaded at once
+TRANSCODE_SLOTS = int(os.environ.get('MUSIC_TRANSCODE_SLOTS', str(os.cpu_count() or 2)))  # MP3 conversions at once
+WORKER_NICENESS = int(os.environ.get('MUSIC_WORKER_NICE', '10'))  # CPU priority of downloader processes
+
+# Admission control: new downloads are refused (429/503) past these limits
+MAX_QUEUE_DEPTH = int(os.environ.get('MUSIC_MAX_QUEUE', '200'))  # Tasks waiting in the queue, see DownloadQueue.depth()
+MAX_WAIT_SECONDS = int(os.environ.get('MUSIC_MAX_WAIT', '300'))  # Estimated queue wait, well below nginx's 600s timeout
+MIN_FREE_BYTES = int(os.environ.get('MUSIC_MIN_FREE_MB', '1024')) * 1024 * 1024  # Free disk in DOWNLOAD_FOLDER
+
+QUALITIES = ['128', '192', '256', '320', 'original']  # 'original' keeps the source audio without converting
+
+# nginx location that serves DOWNLOAD_FOLDER when X_ACCEL_REDIRECT is on
+ACCEL_REDIRECT_PREFIX = '/_protected/music-downloader/'
+
+# Published files are deleted this many seconds after they are ready (or after their task finishes)
+FILE_TTL = int(os.environ.get('MUSIC_FILE_TTL', '30'))
+
+# Converted track cache
+CACHE_MAX_BYTES = int(os.environ.get('MUSIC_CACHE_MAX_MB', '2048')) * 1024 * 1024
+
+# Downloaded source streams, kept briefly so other qualities are converted locally
+SOURCE_TTL = int(os.environ.get('MUSIC_SOURCE_TTL', '1800'))  # Seconds a source is kept (0 = disabled)
+SOURCE_MAX_BYTES = int(os.environ.get('MUSIC_SOURCE_CACHE_MB', '1024')) * 1024 * 1024
+
+# Preflight: a video's info is looked up when it is submitted, so bad URLs fail fast
+INFO_CACHE_SIZE = int(os.environ.get('MUSIC_INFO_CACHE_SIZE', '256'))  # Videos whose info is kept
+INFO_TTL = int(os.environ.get('MUSIC_INFO_TTL', '600'))  # Seconds info is reused; its stream URLs expire
+INFO_ERROR_TTL = 60  # Seconds a video found unavailable is remembered
+PREFLIGHT_SLOTS = int(os.environ.get('MUSIC_PREFLIGHT_SLOTS', '2'))  # Lookups running at once
+PREFLIGHT_TIMEOUT = float(os.environ.get('MUSIC_PREFLIGHT_TIMEOUT', '3'))  # Seconds before queueing without one
+PREFLIGHT_KILL_TIMEOUT = 120  # Seconds before a lookup counts as stuck and its process is killed
+# Lookup errors that mean the video can never be downloaded. Anything else (DNS,
+# timeouts, HTTP 429, "Unable to download API page") may pass, so the download is queued.
+UNAVAILABLE_PATTERN = re.compile(
+    r'Video unavailable|Private video|members[- ]only|Join this channel|'
+    r'not available in your country|blocked it in your country|has been removed|has been terminated', re.I)
+
+def get_source(url):
+    """Return the source name used for per-source concurrency limits"""
+    return 'spotify' if 'spotify.com' in url else 'youtube'
+
+YOUTUBE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def canonical_video_id(url):
+    """
+    Return the YouTube video ID for a single-video URL, or None.
+
+    Playlist URLs return None (radio playlists are reduced to their video by the
+    downloader, so they count as single videos).
+    """
+    try:
+        parsed = urlparse(url if '://' in url else f'https://{url}')
+        host = parsed.netloc.lower().split(':')[0]
+        params = parse_qs(parsed.query)
+    except ValueError:
+        return None
+
+    if 'list' in params and not params['list'][0].startswith('RD'):
+        return None
+
+    video_id = None
+    if host.endswith('youtu.be'):
+        video_id = parsed.path.strip('/').split('/')[0]
+    elif host.endswith('youtube.com'):
+        if parsed.path == '/watch':
+            video_id = params.get('v', [''])[0]
+        elif parsed.path.startswith(('/shorts/', '/live/', '/embed/')):
+            video_id = parsed.path.split('/')[2]
+
+    if video_id and YOUTUBE_ID_PATTERN.match(video_id):
+        return video_id
+    return None
+
+SPOTIFY_PATH_PATTERN = re.compile(r'/(?:intl-[a-z]+/)?(track|album|playlist)/([A-Za-z0-9]+)')
+
+def canonical_media_id(url):
+    """Return a stable ID for what a URL downloads (video, playlist or Spotify item), or None"""
+    video_id = canonical_video_id(url)
+    if video_id:
+        return f"youtube:{video_id}"
+    try:
+        parsed = urlparse(url if '://' in url else f'https://{url}')
+    except ValueError:
+        return None
+    if 'spotify.com' in parsed.netloc:
+        match = SPOTIFY_PATH_PATTERN.match(parsed.path)
+        if match:
+            return f"spotify:{match.group(1)}:{match.group(2)}"
+    elif 'youtube.com' in parsed.netloc:
+        playlist = parse_qs(parsed.query).get('list', [''])[0]
+        if playlist and not playlist.startswith('RD'):
+            return f"youtube-playlist:{playlist}"
+    return None
+
+# Metrics, rendered in Prometheus text format by /metrics in main.py
+stage_seconds = Histogram(STAGE_BUCKETS)  # preflight, queued, extract, fetch, transcode, publish, serve
+fetched_bytes = Counter()
+served_bytes = Counter()
+download_outcomes = Counter()  # Finished downloads by platform and status
+
+class DownloadQueue:
+    """
+    FIFO queue that hands out the oldest task whose source has a free slot.
+
+    Videos of an expanded playlist are also limited to `playlist_limit` running
+    at once, so one large playlist can't take every slot.
+    """
+    def __init__(self, source_limits, playlist_limit):
+        self.source_limits = dict(source_limits)
+        self.playlist_limit = playlist_limit
+        self.running = {source: 0 for source in source_limits}
+        self.playlist_running = {}  # Parent task ID -> running children
+        self.pending = deque()
+        self.busy_workers = 0
+        self.wait_times = deque(maxlen=100)  # Recent queue wait times in seconds
+        self.run_times = {source: deque(maxlen=50) for source in source_limits}  # Recent task durations
+        self.condition = threading.Condition()
+
+    def put(self, task):
+        with self.condition:
+            task.queued_at = time.time()
+            self.pending.append(task)
+            self.condition.notify_all()
+
+    def get(self):
+        """Block until a task can run without exceeding its source or playlist limit"""
+        with self.condition:
+            while True:
+                for task in self.pending:
+                    source = task.source
+                    if self.running.get(source, 0) >= self.source_limits.get(source, 1):
+                        continue
+                    if task.parent and self.playlist_running.get(task.parent.task_id, 0) >= self.playlist_limit:
+                        continue
+                    self.pending.remove(task)
+                    self.running[source] = self.running.get(source, 0) + 1
+                    if task.parent:
+                        parent_id = task.parent.task_id
+                        self.playlist_running[parent_id] = self.playlist_running.get(parent_id, 0) + 1
+                    self.busy_workers += 1
+                    task.started_at = time.time()
+                    self.wait_times.append(task.started_at - task.queued_at)
+                    stage_seconds.observe(task.started_at - task.queued_at, stage='queued')
+                    return task
+                self.condition.wait()
+
+    def task_done(self, task):
+        with self.condition:
+            self.run_times.setdefault(task.source, deque(maxlen=50)).append(time.time() - task.started_at)
+            self.running[task.source] -= 1
+            if task.parent:
+                parent_id = task.parent.task_id
+                self.playlist_running[parent_id] -= 1
+                if not self.playlist_running[parent_id]:
+                    del self.playlist_running[parent_id]
+            self.busy_workers -= 1
+            self.condition.notify_all()
+
+    def qsize(self):
+        return len(self.pending)
+
+    def depth(self, source=None):
+        """
+        Pending tasks (of `source`) that hold up a new one. The videos of each
+        playlist count as one lane of at most playlist_limit, since no more of
+        them run at once and other tasks get the remaining slots.
+        """
+        with self.condition:
+            return self._depth(source)
+
+    def _depth(self, source):
+        standalone = 0
+        playlists = {}  # Parent task ID -> pending children
+        for task in self.pending:
+            if source and task.source != source:
+                continue
+            if task.parent:
+                parent_id = task.parent.task_id
+                playlists[parent_id] = playlists.get(parent_id, 0) + 1
+            else:
+                standalone += 1
+        return standalone + sum(min(count, self.playlist_limit) for count in playlists.values())
+
+    def position(self, task):
+        """1-based position of a task in the queue, or 0 if it is not waiting"""
+        with self.condition:
+            for index, pending_task in enumerate(self.pending):
+                if pending_task is task:
+                    return index + 1
+        return 0
+
+    def estimate_wait(self, source):
+        """
+        Rough seconds a new task for `source` would wait: the queued (see depth())
+        and running tasks ahead of it, in waves of the source's slots, times the
+        recent average task duration (0 until some tasks have finished).
+        """
+        with self.condition:
+            runs = self.run_times.get(source)
+            if not runs:
+                return 0
+            slots = max(1, min(WORKER_COUNT, self.source_limits.get(source, 1)))
+            ahead = self._depth(source) + self.running.get(source, 0)
+            return ahead // slots * (sum(runs) / len(runs))
+
+    def stats(self):
+        with self.condition:
+            waits = list(self.wait_times)
+            sources = {}
+            for source, limit in self.source_limits.items():
+                sources[source] = {
+                    'running': self.running.get(source, 0),
+                    'limit': limit,
+                    'queued': sum(1 for task in self.pending if task.source == source),
+                }
+            return {
+                'queue_depth': len(self.pending),
+                'workers': WORKER_COUNT,
+                'busy_workers': self.busy_workers,
+                'utilization': round(self.busy_workers / WORKER_COUNT, 3) if WORKER_COUNT else 0,
+                'sources': sources,
+                'avg_wait_seconds': round(sum(waits) / len(waits), 2) if waits else 0,
+                'max_wait_seconds': round(max(waits), 2) if waits else 0,
+            }
+
+# Task store limits
+TASK_TTL = int(os.environ.get('MUSIC_TASK_TTL', '3600'))  # Seconds finished tasks are kept
+MAX_TASKS = int(os.environ.get('MUSIC_MAX_TASKS', '5000'))  # Finished tasks are evicted beyond this
+LOG_LINES = 100  # Log lines kept per task
+
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Saved task state, so queued and running jobs survive a restart. 'memory' keeps
+# state in this process only.
+STATE_BACKEND = os.environ.get('MUSIC_STATE_BACKEND', 'sqlite')
+STATE_DB = os.environ.get('MUSIC_STATE_DB', os.path.join(DATA_DIR, 'music_state.db'))
+STATE_SYNC_INTERVAL = 0.5  # Seconds between writes of changed tasks to the state store
+WORKER_HEARTBEAT = 5  # Seconds between liveness updates of this process
+WORKER_TIMEOUT = 30  # A previous process silent for this long is gone and its jobs are re-queued
+
+class TaskStore:
+    """
+    Tasks by ID, oldest first. Finished tasks are evicted after TASK_TTL seconds,
+    or earlier (oldest first) once more than MAX_TASKS are stored. Tasks that are
+    still queued or downloading are never evicted.
+    """
+    def __init__(self, ttl, max_tasks):
+        self.ttl = ttl
+        self.max_tasks = max_tasks
+        self.tasks = OrderedDict()
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def __getitem__(self, task_id):
+        return self.tasks[task_id]
+
+    def __setitem__(self, task_id, task):
+        with self.lock:
+            self.tasks[task_id] = task
+        if len(self.tasks) > self.max_tasks:
+            self.evict()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def get(self, task_id, default=None):
+        return self.tasks.get(task_id, default)
+
+    def items(self):
+        with self.lock:
+            return list(self.tasks.items())
+
+    def evict(self):
+        """Drop expired finished tasks, then the oldest finished ones while over the limit"""
+        now = time.time()
+        with self.lock:
+            finished = []
+            for task_id, task in self.tasks.items():
+                if task.status not in FINISHED_STATUSES:
+                    continue
+                if task.finished_at is None:
+                    task.finished_at = now
+                finished.append((task.finished_at, task_id))
+
+            finished.sort()
+            overflow = len(self.tasks) - self.max_tasks
+            for index, (finished_at, task_id) in enumerate(finished):
+                if now - finished_at < self.ttl and index >= overflow:
+                    break
+                del self.tasks[task_id]
+                self.evicted += 1
+
+    def stats(self):
+        """Task counts and approximate memory used by task records"""
+        with self.lock:
+            tasks = list(self.tasks.values())
+        active = sum(1 for task in tasks if task.status not in FINISHED_STATUSES)
+        return {
+            'tasks': len(tasks),
+            'active': active,
+            'finished': len(tasks) - active,
+            'evicted': self.evicted,
+            'approx_bytes': sum(task.memory_usage() for task in tasks),
+        }
+
+class MemoryStateBackend(MemoryStore):
+    """State kept only in this process; tasks live in active_downloads"""
+    def save_tasks(self, worker_id, records):
+        pass
+
+    def claim_orphans(self, worker_id, timeout):
+        return []
+
+    def unfinished_task_ids(self):
+        return set()
+
+    def evict(self, ttl):
+        pass
+
+class SQLiteStateBackend(SQLiteStore):
+    """
+    Tasks and the process running them in the database. Unfinished tasks of a
+    process that stopped are claimed and re-run by the next one.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            parent_id TEXT,
+            owner TEXT,
+            status TEXT NOT NULL,
+            record TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_owner ON tasks (owner, status);
+    """
+
+    def save_tasks(self, worker_id, records):
+        """Insert or update (task_id, record) pairs owned by a worker, in one transaction"""
+        now = time.time()
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'INSERT INTO tasks (task_id, parent_id, owner, status, record, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (task_id) DO UPDATE SET owner = excluded.owner, status = excluded.status, '
+                'record = excluded.record, updated_at = excluded.updated_at',
+                [(task_id, record.get('parent_id'), worker_id, record['status'], json.dumps(record), now)
+                 for task_id, record in records])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def claim_orphans(self, worker_id, timeout):
+        """
+        Take over unfinished top-level tasks of processes that stopped sending
+        heartbeats. Playlist videos are not claimed, their playlist is re-expanded.
+        Returns (task_id, record) for each claimed task.
+        """
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            live = 'SELECT worker_id FROM workers WHERE heartbeat >= ?'
+            deadline = time.time() - timeout
+            rows = db.execute(
+                f'SELECT task_id, record FROM tasks WHERE status IN (?, ?) '
+                f'AND parent_id IS NULL AND (owner IS NULL OR owner NOT IN ({live}))',
+                ('queued', 'downloading', deadline)).fetchall()
+            db.executemany('UPDATE tasks SET owner = ? WHERE task_id = ?',
+                           [(worker_id, row[0]) for row in rows])
+            # Unfinished videos of orphaned playlists are replaced when the playlist is expanded again
+            db.execute(
+                f"UPDATE tasks SET status = 'failed', owner = NULL WHERE status IN (?, ?) "
+                f"AND parent_id IS NOT NULL AND (owner IS NULL OR owner NOT IN ({live}))",
+                ('queued', 'downloading', deadline))
+            db.execute('DELETE FROM workers WHERE heartbeat < ?', (deadline,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return [(task_id, json.loads(record)) for task_id, record in rows]
+
+    def unfinished_task_ids(self):
+        """Tasks still queued or downloading, whichever process ran them"""
+        rows = self._connect().execute('SELECT task_id FROM tasks WHERE status IN (?, ?)',
+                                       ('queued', 'downloading')).fetchall()
+        return {row[0] for row in rows}
+
+    def evict(self, ttl):
+        """Forget finished tasks older than ttl seconds"""
+        self._connect().execute(
+            'DELETE FROM tasks WHERE status IN (?, ?, ?) AND updated_at < ?',
+            FINISHED_STATUSES + (time.time() - ttl,))
+
+def open_state_backend():
+    """The configured state backend, falling back to process memory if the database can't be opened"""
+    if STATE_BACKEND == 'sqlite':
+        try:
+            return SQLiteStateBackend(STATE_DB)
+        except Exception as e:
+            print(f"State database error, keeping state in memory: {e}")
+    return MemoryStateBackend()
 
 # Global download queue and status tracking
-download_queue = queue.Queue()
-active_downloads = {}
-download_history = []
-total_downloads = 0  # Global stats counter
+download_queue = DownloadQueue(SOURCE_LIMITS, PLAYLIST_PARALLEL)
+active_downloads = TaskStore(TASK_TTL, MAX_TASKS)
+download_history = deque(maxlen=1000)
+total_downloads = 0  # Downloads finished by this process; the saved total is in state_store
+state_store = open_state_backend()
 
 class DownloadTask:
+    __slots__ = ('task_id', 'url', 'quality', 'source', 'video_id', 'media_key', 'primary',
+                 'subscribers', 'parent', 'children', 'fast_path', 'queued_at', 'started_at', 'finished_at', 'status',
+                 'progress', 'stage', 'downloaded_bytes', 'total_bytes', 'speed', 'eta',
+                 'transcode_seconds', 'current_file', 'title', 'media', 'playlist_count', 'playlist_current', 'error',
+                 'files', 'logs', 'log_total', 'process')
+
     def __init__(self, task_id, url, quality='320'):
         self.task_id = task_id
         self.url = url
         self.quality = quality
+        self.source = get_source(url)
+        self.video_id = canonical_video_id(url)
+        media_id = canonical_media_id(url)
+        self.media_key = f"{media_id}@{quality}" if media_id else None
+        self.primary = None  # The in-flight task this one is attached to
+        self.subscribers = []  # Identical tasks attached to this one
+        self.parent = None  # The playlist task this video belongs to
+        self.children = []  # One task per video, for expanded playlists
+        self.fast_path = None  # 'cache' (result cache) or 'derived' (converted from a cached source)
+        self.queued_at = None
+        self.started_at = None
+        self.finished_at = None  # Set by the task store when it first sees the task finished
         self.status = 'queued'
         self.progress = 0
+        self.stage = ''  # fetch, transcode or tag
+        self.downloaded_bytes = 0
+        self.total_bytes = 0
+        self.speed = None  # Bytes per second
+        self.eta = None  # Seconds
+        self.transcode_seconds = 0  # Time spent converting, for all files
         self.current_file = ''
         self.title = ''
+        self.media = None  # Title, duration, thumbnail and uploader from the preflight
         self.playlist_count = 0
         self.playlist_current = 0
         self.error = None
         self.files = []
-        self.logs = []
+        self.logs = deque(maxlen=LOG_LINES)
+        self.log_total = 0  # Lines ever logged, used as a cursor for streamed updates
         self.process = None
 
-def process_downloads():
-    """Background worker that processes the download queue"""
-    while True:
+    @property
+    def folder_id(self):
+        """Folder under DOWNLOAD_FOLDER that finished files are published to"""
+        return self.parent.task_id if self.parent else self.task_id
+
+    @property
+    def is_playlist(self):
+        """True for YouTube playlists, which are expanded into one task per video"""
+        return bool(self.media_key) and self.media_key.startswith('youtube-playlist:')
+
+    def log(self, line):
+        """Add a log line, keeping the last LOG_LINES"""
+        self.logs.append(line)
+        self.log_total += 1
+
+    def recent_logs(self, count=20):
+        return list(islice(self.logs, max(0, len(self.logs) - count), None))
+
+    def logs_since(self, cursor):
+        """Log lines added after the given log_total value"""
+        return self.recent_logs(min(self.log_total - cursor, len(self.logs)))
+
+    def memory_usage(self):
+        """Approximate bytes held by this record, its logs and file names"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.logs) + sys.getsizeof(self.files)
+        size += sum(sys.getsizeof(line) for line in self.logs)
+        size += sum(sys.getsizeof(name) for name in self.files)
+        return size + sys.getsizeof(self.url) + sys.getsizeof(self.title)
+
+def task_record(task):
+    """A task as written to the state store, with what is needed to re-run it after a restart"""
+    record = task_state(task)
+    record.update({
+        'url': task.url,
+        'quality': task.quality,
+        'parent_id': task.parent.task_id if task.parent else None,
+        'folder_id': task.folder_id,
+        'files': list(task.files),
+        'logs': task.recent_logs(20),
+        'log_cursor': task.log_total,
+    })
+    return record
+
+def persist_task(task):
+    """Write a task to the state store right away, so an accepted job survives a crash"""
+    try:
+        state_store.save_tasks(worker_id, [(task.task_id, task_record(task))])
+    except Exception as e:
+        print(f"State store error: {e}")
+
+def total_download_count():
+    """Downloads finished since the first start, including ones this process hasn't synced yet"""
+    return state_store.total() + total_downloads - synced_total
+
+# Warm downloader processes
+if os.name == 'nt':  # Windows
+    PYTHON_PATH = r"C:\Users\Thorton\AppData\Local\Programs\Python\Python312\python.exe"
+else:
+    PYTHON_PATH = 'python3'
+DOWNLOADER_PATH = os.path.join(APP_DIR, 'downloader.py')
+
+class DownloaderProcess:
+    """A long-lived `downloader.py --serve` process with yt-dlp already imported"""
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [PYTHON_PATH, DOWNLOADER_PATH, '--serve', '--nice', str(WORKER_NICENESS)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            bufsize=1,
+            cwd=APP_DIR
+        )
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def submit(self, job):
+        """Send one job to the process"""
+        self.process.stdin.write(json.dumps(job) + '\n')
+        self.process.stdin.flush()
+
+    def grant_transcode(self):
+        """Let the process start the conversion it asked for with a 'transcode' event"""
+        self.process.stdin.write('\n')
+        self.process.stdin.flush()
+
+    def events(self):
+        """Yield events for the current job until it is done or the process exits"""
+        for line in self.process.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            event = None
+            if line.startswith('{'):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    pass
+            if not isinstance(event, dict) or 'event' not in event:
+                # Output that bypassed the event channel (e.g. interpreter warnings)
+                event = {'event': 'log', 'line': line}
+            if event['event'] == 'ready':
+                continue
+            yield event
+            if event['event'] == 'done':
+                return
+        # The process exited without finishing the job
+        yield {'event': 'done', 'ok': False}
+
+    def terminate(self):
         try:
-            task = download_queue.get()
-            if task is None:
-                break
+            self.process.terminate()
+        except Exception:
+            pass
+
+    def wait(self, timeout=5):
+        """Wait for a terminated process to exit so it stops writing files"""
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class DownloaderPool:
+    """Keeps up to `size` idle downloader processes ready for new jobs"""
+    def __init__(self, size):
+        self.size = size
+        self.idle = deque()
+        self.busy = set()  # Processes handed out and not released yet
+        self.closed = False
+        self.lock = threading.Lock()
 
-            task_id = task.task_id
-            url = task.url
-            active_downloads[task_id].status = 'downloading'
+    def acquire(self):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Downloader pool is closed")
+            while self.idle:
+                process = self.idle.popleft()
+                if process.alive():
+                    self.busy.add(process)
+                    return process
+            process = DownloaderProcess()
+            self.busy.add(process)
+            return process
 
-            # Create unique folder for this download
-            download_path = os.path.join(TEMP_FOLDER, task_id)
-            os.makedirs(download_path, exist_ok=True)
+    def release(self, process):
+        """Return a process after its job; crashed or cancelled ones are dropped"""
+        with self.lock:
+            self.busy.discard(process)
+            if process.alive() and not self.closed and len(self.idle) < self.size:
+                self.idle.append(process)
+                return
+        process.terminate()
 
+    def close(self):
+        """Stop every process, idle or running a job, and wait until they have exited"""
+        with self.lock:
+            self.closed = True
+            processes = list(self.idle) + list(self.busy)
+            self.idle.clear()
+            self.busy.clear()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    def prewarm(self):
+        """Start processes in the background so the first jobs don't wait for imports"""
+        for _ in range(self.size):
+            self.release(DownloaderProcess())
+
+downloader_pool = DownloaderPool(WORKER_COUNT)
+
+class TranscodeScheduler:
+    """
+    Caps MP3 conversions running at once across all downloader processes.
+
+    Each process asks for a slot before starting ffmpeg (a Spotify job asks for one
+    per spotdl thread) and reports how long the conversion took, so the box isn't
+    oversubscribed when many downloads finish fetching at the same time.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.durations = deque(maxlen=100)  # Recent conversion times in seconds
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None, count=1):
+        """Wait for count free slots; returns the number taken, 0 if none within timeout"""
+        count = max(1, min(count, self.limit))
+        with self.condition:
+            self.waiting += 1
             try:
-                # Run the downloader with quality parameter
-                if os.name == 'nt':  # Windows
-                    python_path = r"C:\Users\Thorton\AppData\Local\Programs\Python\Python312\python.exe"
-                else:
-                    python_path = 'python3'
-
-                downloader_path = os.path.join(APP_DIR, 'downloader.py')
-
-                # Track files before download
-                files_before = set()
-                if os.path.exists(DOWNLOAD_FOLDER):
-                    for root, dirs, files in os.walk(DOWNLOAD_FOLDER):
-                        for file in files:
-                            if file.endswith('.mp3'):
-                                files_before.add(os.path.join(root, file))
-
-                files_sent = set()
-
-                process = subprocess.Popen(
-                    [python_path, downloader_path, url, '--quality', task.quality],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    bufsize=1,
-                    cwd=os.path.dirname(__file__)
-                )
-
-                active_downloads[task_id].process = process
-
-                def check_for_new_files():
-                    """Check for newly completed files"""
-                    if os.path.exists(DOWNLOAD_FOLDER):
-                        for root, dirs, files in os.walk(DOWNLOAD_FOLDER):
-                            for file in files:
-                                if file.endswith('.mp3'):
-                                    full_path = os.path.join(root, file)
-                                    if full_path not in files_before and full_path not in files_sent:
-                                        rel_path = os.path.relpath(full_path, DOWNLOAD_FOLDER)
-                                        if rel_path not in active_downloads[task_id].files:
-                                            active_downloads[task_id].files.append(rel_path)
-                                            files_sent.add(full_path)
-                                            if active_downloads[task_id].playlist_count > 1:
-                                                completed = len(active_downloads[task_id].files)
-                                                total = active_downloads[task_id].playlist_count
-                                                active_downloads[task_id].title = f"Playlist ({completed}/{total} ready)"
-                                            active_downloads[task_id].logs.append(f"✅ Ready: {rel_path}")
-
-                for line in process.stdout:
-                    if active_downloads[task_id].status == 'cancelled':
-                        process.terminate()
-                        break
+                if not self.condition.wait_for(lambda: self.running + count <= self.limit, timeout):
+                    return 0
+                self.running += count
+                return count
+            finally:
+                self.waiting -= 1
+
+    def release(self, seconds=None, count=1):
+        with self.condition:
+            self.running -= count
+            if seconds is not None:
+                self.completed += 1
+                self.durations.append(seconds)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            durations = list(self.durations)
+            return {
+                'running': self.running,
+                'limit': self.limit,
+                'waiting': self.waiting,
+                'completed': self.completed,
+                'avg_seconds': round(sum(durations) / len(durations), 2) if durations else 0,
+                'max_seconds': round(max(durations), 2) if durations else 0,
+            }
+
+transcode_scheduler = TranscodeScheduler(TRANSCODE_SLOTS)
+
+# How much of one item's progress each stage covers: (start, end)
+STAGE_PROGRESS = {
+    'fetch': (0.0, 0.85),
+    'transcode': (0.85, 0.97),
+    'tag': (0.97, 1.0),
+}
+
+def apply_progress(task, event):
+    """Update a task from a downloader 'progress' event"""
+    stage = event.get('stage', 'fetch')
+    item = event.get('item') or 1
+    count = event.get('count') or 1
+    task.stage = stage
+    task.playlist_current = item
+    task.playlist_count = count
+
+    if event.get('title'):
+        task.current_file = event['title']
+        if count <= 1:
+            task.title = event['title']
+        elif len(task.files) == 0:
+            task.title = f"Playlist ({item}/{count})"
+
+    # Fraction of the current item that is done
+    start, end = STAGE_PROGRESS.get(stage, (0.0, 1.0))
+    if stage == 'fetch':
+        task.downloaded_bytes = event.get('downloaded_bytes') or 0
+        task.total_bytes = event.get('total_bytes') or 0
+        task.speed = event.get('speed')
+        task.eta = event.get('eta')
+        fraction = task.downloaded_bytes / task.total_bytes if task.total_bytes else 0
+        item_done = start + (end - start) * min(fraction, 1.0)
+    else:
+        item_done = end if event.get('state') == 'finished' else start
+
+    task.progress = min(99, int((item - 1 + item_done) / count * 100))
+
+def task_folder_busy(path):
+    """True while the task that owns a published file is still queued or downloading"""
+    folder = os.path.relpath(os.path.dirname(path), DOWNLOAD_FOLDER)
+    task = active_downloads.get(folder)
+    return task is not None and task.status not in FINISHED_STATUSES
+
+file_expiry = ExpiryScheduler(DOWNLOAD_FOLDER, FILE_TTL, is_busy=task_folder_busy)
+
+def publish_file(task_id, path, folder_id=None):
+    """
+    Move a finished file from the task's staging folder into DOWNLOAD_FOLDER/<folder_id>
+    (the task's own folder unless given, e.g. the playlist's folder for its videos).
+
+    The rename is atomic, so /download/<path> never sees a partially written file.
+    Returns the path relative to DOWNLOAD_FOLDER, or None if the file is missing.
+    """
+    folder_id = folder_id or task_id
+    staging_folder = os.path.abspath(os.path.join(TEMP_FOLDER, task_id))
+    path = os.path.abspath(path)
+    if not path.startswith(staging_folder + os.sep) or not os.path.isfile(path):
+        return None
+
+    publish_folder = os.path.join(DOWNLOAD_FOLDER, folder_id)
+    os.makedirs(publish_folder, exist_ok=True)
+    filename = os.path.basename(path)
+    published_path = os.path.join(publish_folder, filename)
+    os.replace(path, published_path)
+    file_expiry.schedule(published_path)
+    return f"{folder_id}/{filename}"
+
+def link_or_copy(source, destination):
+    """Hard link a file (cheap, same disk) or copy it if linking isn't possible"""
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return  # Already linked, e.g. by a concurrent task for the same video
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        shutil.copy2(source, destination)
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of converted tracks keyed by (video ID, quality).
+
+    Entries live in CACHE_FOLDER/<video_id>-<quality>/<title>.<ext> and are hard
+    linked into task folders, so a hit costs no download or conversion.
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (path, size), least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Index the entries left on disk by a previous run, oldest first"""
+        found = []
+        for key in os.listdir(self.folder):
+            entry_folder = os.path.join(self.folder, key)
+            if not os.path.isdir(entry_folder):
+                continue
+            for name in os.listdir(entry_folder):
+                path = os.path.join(entry_folder, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime, key, path, stat.st_size))
+        with self.lock:
+            for _, key, path, size in sorted(found):
+                self.entries[key] = (path, size)
+                self.total_bytes += size
+            self._evict()
+
+    def get(self, video_id, quality, count_miss=True):
+        """Return the cached file for a track, or None"""
+        if not video_id:
+            return None
+        key = f"{video_id}-{quality}"
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and os.path.exists(entry[0]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += entry[1]
+                return entry[0]
+            if entry:
+                # Removed from disk behind our back
+                del self.entries[key]
+                self.total_bytes -= entry[1]
+            if count_miss:
+                self.misses += 1
+            return None
+
+    def add(self, video_id, quality, path):
+        """Store a copy of a converted track"""
+        key = f"{video_id}-{quality}"
+        with self.lock:
+            if key in self.entries:
+                return
+            entry_folder = os.path.join(self.folder, key)
+            os.makedirs(entry_folder, exist_ok=True)
+            cached_path = os.path.join(entry_folder, os.path.basename(path))
+            link_or_copy(path, cached_path)
+            size = os.path.getsize(cached_path)
+            self.entries[key] = (cached_path, size)
+            self.total_bytes += size
+            self._evict()
 
-                    log_line = line.rstrip()
-                    active_downloads[task_id].logs.append(log_line)
-
-                    # Parse playlist info
-                    if '[download] Downloading item' in log_line or 'Downloading video' in log_line:
-                        try:
-                            import re
-                            match = re.search(r'(\d+)\s+of\s+(\d+)', log_line)
-                            if match:
-                                current = int(match.group(1))
-                                total = int(match.group(2))
-                                active_downloads[task_id].playlist_current = current
-                                active_downloads[task_id].playlist_count = total
-                                if total > 1:
-                                    active_downloads[task_id].title = f"Playlist ({current}/{total})"
-                        except:
-                            pass
-
-                    # Extract title
-                    if active_downloads[task_id].playlist_count <= 1:
-                        if '[download] Destination:' in log_line:
-                            try:
-                                title = log_line.split('[download] Destination:')[-1].strip()
-                                title = os.path.splitext(os.path.basename(title))[0]
-                                active_downloads[task_id].title = title
-                            except:
-                                pass
-
-                    if len(active_downloads[task_id].logs) > 100:
-                        active_downloads[task_id].logs.pop(0)
-
-                    if "Download complete" in log_line or "complete!" in log_line.lower():
-                        active_downloads[task_id].progress = 100
-
-                    check_for_new_files()
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, (path, size) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
 
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'bytes_saved': self.bytes_saved,
+                'evictions': self.evictions,
+            }
+
+result_cache = ResultCache(CACHE_FOLDER, CACHE_MAX_BYTES)
+try:
+    result_cache.load()
+except Exception as e:
+    print(f"Cache load error: {e}")
+
+class SourceCache:
+    """
+    Short-lived cache of downloaded source streams (before conversion) by video ID.
+
+    Entries live in SOURCE_FOLDER/<video_id>/ as the stream plus an info.json with
+    the fields needed to name and tag converted files. Another quality of a cached
+    video is converted from the stream locally instead of being downloaded again.
+    Entries expire `ttl` seconds after the download, oldest first when over size.
+    """
+    def __init__(self, folder, max_bytes, ttl):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # video_id -> (path, size, added_at), oldest first
+        self.total_bytes = 0
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Index the entries left on disk by a previous run"""
+        found = []
+        for video_id in os.listdir(self.folder):
+            entry_folder = os.path.join(self.folder, video_id)
+            if not os.path.isdir(entry_folder):
+                continue
+            for name in os.listdir(entry_folder):
+                if name != 'info.json':
+                    stat = os.stat(os.path.join(entry_folder, name))
+                    found.append((stat.st_mtime, video_id, os.path.join(entry_folder, name), stat.st_size))
+        with self.lock:
+            for added_at, video_id, path, size in sorted(found):
+                self.entries[video_id] = (path, size, added_at)
+                self.total_bytes += size
+            self._evict()
+
+    def get(self, video_id):
+        """Return (stream path, info) for a video, or None"""
+        if not video_id or not self.ttl:
+            return None
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if not entry or time.time() - entry[2] > self.ttl or not os.path.exists(entry[0]):
+                return None
+            try:
+                with open(os.path.join(os.path.dirname(entry[0]), 'info.json'), encoding='utf-8') as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self.hits += 1
+            return entry[0], info
+
+    def add(self, video_id, path, info):
+        """Move a downloaded stream out of a staging folder into the cache"""
+        if not self.ttl or not video_id or not YOUTUBE_ID_PATTERN.match(video_id):
+            return
+        entry_folder = os.path.join(self.folder, video_id)
+        with self.lock:
+            old = self.entries.pop(video_id, None)
+            if old:
+                self.total_bytes -= old[1]
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            os.makedirs(entry_folder)
+            cached_path = os.path.join(entry_folder, os.path.basename(path))
+            os.replace(path, cached_path)
+            with open(os.path.join(entry_folder, 'info.json'), 'w', encoding='utf-8') as f:
+                json.dump(info or {}, f)
+            size = os.path.getsize(cached_path)
+            self.entries[video_id] = (cached_path, size, time.time())
+            self.total_bytes += size
+            self._evict()
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then the oldest ones while over the size limit"""
+        now = time.time()
+        while self.entries:
+            video_id, (path, size, added_at) = next(iter(self.entries.items()))
+            if now - added_at <= self.ttl and self.total_bytes <= self.max_bytes:
+                break
+            del self.entries[video_id]
+            self.total_bytes -= size
+            self.evictions += 1
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'derived': self.hits,
+                'evictions': self.evictions,
+            }
+
+source_cache = SourceCache(SOURCE_FOLDER, SOURCE_MAX_BYTES, SOURCE_TTL)
+try:
+    source_cache.load()
+except Exception as e:
+    print(f"Source cache load error: {e}")
+
+class InfoCache:
+    """
+    Video info from preflight lookups by video ID, least recently used first.
+
+    Entries expire after `ttl` seconds (failed lookups after `error_ttl`), since
+    the stream URLs in the info are only valid for a few hours.
+    """
+    def __init__(self, max_entries, ttl, error_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.entries = OrderedDict()  # video_id -> (expires_at, info, error)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, video_id, count_miss=True):
+        """Return (info, error) for a video, or None if it isn't cached"""
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(video_id)
+                self.hits += 1
+                return entry[1], entry[2]
+            if entry:
+                del self.entries[video_id]
+            if count_miss:
+                self.misses += 1
+            return None
+
+    def add(self, video_id, info=None, error=None):
+        expires_at = time.time() + (self.error_ttl if error else self.ttl)
+        with self.lock:
+            self.entries[video_id] = (expires_at, info, error)
+            self.entries.move_to_end(video_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+            }
+
+info_cache = InfoCache(INFO_CACHE_SIZE, INFO_TTL, INFO_ERROR_TTL)
+preflight_pool = DownloaderPool(PREFLIGHT_SLOTS)  # Kept apart so lookups never wait for downloads
+preflight_slots = threading.BoundedSemaphore(PREFLIGHT_SLOTS)
+
+preflight_lookups = {}  # video_id -> Event set (with .result) when its running lookup finishes
+preflight_lock = threading.Lock()
+
+def preflight(video_id, url):
+    """
+    Look up a video's info without downloading it, from info_cache or a warm
+    downloader process.
+
+    Returns (info, error). Only errors matching UNAVAILABLE_PATTERN are returned;
+    for other errors, or no answer within PREFLIGHT_TIMEOUT, both are None and the
+    download goes ahead without a preflight. A lookup that is still running then
+    carries on and fills info_cache for the worker.
+    """
+    cached = info_cache.get(video_id)
+    if cached:
+        return cached
+
+    deadline = time.time() + PREFLIGHT_TIMEOUT
+    with preflight_lock:
+        done = preflight_lookups.get(video_id)
+    if done is None:
+        if not preflight_slots.acquire(timeout=PREFLIGHT_TIMEOUT):
+            return None, None
+        with preflight_lock:
+            done = preflight_lookups.get(video_id)
+            if done is None:
+                done = preflight_lookups[video_id] = threading.Event()
+                done.result = (None, None)
+                threading.Thread(target=run_preflight, args=(video_id, url, done),
+                                 name='music-preflight', daemon=True).start()
+            else:
+                preflight_slots.release()  # Another request started the same lookup meanwhile
+
+    if not done.wait(max(0, deadline - time.time())):
+        return None, None
+    return done.result
+
+def run_preflight(video_id, url, done):
+    """Run one lookup (holding a preflight slot), cache its answer and wake the requests waiting for it"""
+    started = time.time()
+    process = None
+    timer = None
+    info = error = None
+    try:
+        process = preflight_pool.acquire()
+        # Only a lookup that is really stuck is killed, which ends its events
+        timer = threading.Timer(PREFLIGHT_KILL_TIMEOUT, process.terminate)
+        timer.daemon = True
+        timer.start()
+        process.submit({'op': 'info', 'url': url})
+        for event in process.events():
+            if event['event'] == 'info':
+                info, error = event.get('info'), event.get('error')
+    except Exception as e:
+        print(f"Preflight error: {e}")
+    finally:
+        if timer:
+            timer.cancel()
+        if process:
+            if info is None and error is None:
+                process.terminate()
                 process.wait()
-                check_for_new_files()
-
-                if process.returncode == 0:
-                    files_after = set()
-                    downloaded_files = []
-
-                    if os.path.exists(DOWNLOAD_FOLDER):
-                        for root, dirs, files in os.walk(DOWNLOAD_FOLDER):
-                            for file in files:
-                                if file.endswith('.mp3'):
-                                    full_path = os.path.join(root, file)
-                                    files_after.add(full_path)
-
-                    new_files = files_after - files_before
-
-                    for file_path in new_files:
-                        rel_path = os.path.relpath(file_path, DOWNLOAD_FOLDER)
-                        downloaded_files.append(rel_path)
-
-                    # Merge with existing files
-                    for file in downloaded_files:
-                        if file not in active_downloads[task_id].files:
-                            active_downloads[task_id].files.append(file)
-
-                    active_downloads[task_id].status = 'completed'
-                    active_downloads[task_id].progress = 100
-
-                    # Increment global stats
-                    global total_downloads
-                    total_downloads += len(downloaded_files) if downloaded_files else 1
-
-                    if not active_downloads[task_id].title and downloaded_files:
-                        try:
-                            first_file = downloaded_files[0]
-                            title = os.path.splitext(os.path.basename(first_file))[0]
-                            active_downloads[task_id].title = title
-                        except:
-                            pass
-
-                    if not downloaded_files:
-                        active_downloads[task_id].logs.append("Warning: No new files detected")
-                elif active_downloads[task_id].status == 'cancelled':
-                    # Clean up partial files
-                    if os.path.exists(DOWNLOAD_FOLDER):
-                        for root, dirs, files in os.walk(DOWNLOAD_FOLDER):
-                            for file in files:
-                                full_path = os.path.join(root, file)
-                                if full_path not in files_before:
-                                    try:
-                                        os.remove(full_path)
-                                        print(f"Cleaned up partial file: {file}")
-                                    except Exception as e:
-                                        print(f"Error cleaning up {file}: {e}")
-                else:
-                    active_downloads[task_id].status = 'failed'
-                    active_downloads[task_id].error = 'Download failed'
+            preflight_pool.release(process)
+        preflight_slots.release()
+    stage_seconds.observe(time.time() - started, stage='preflight')
+
+    try:
+        if error:
+            if not UNAVAILABLE_PATTERN.search(error) or 'try again later' in error.lower():
+                print(f"Preflight lookup failed, queueing anyway: {error}")
+                error = None
+            else:
+                # "ERROR: [youtube] <id>: Video unavailable" -> "Video unavailable"
+                error = re.sub(r'^(ERROR:\s*)?(\[[^\]]+\]\s*[\w-]+:\s*)?', '', error.strip()) or 'This video is unavailable'
+        if info or error:
+            info_cache.add(video_id, info, error)
+        done.result = (info, error)
+    finally:
+        with preflight_lock:
+            preflight_lookups.pop(video_id, None)
+        done.set()
+
+def media_summary(info):
+    """The parts of a video's info shown in the UI"""
+    return {
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'thumbnail': info.get('thumbnail'),
+        'uploader': info.get('uploader') or info.get('channel'),
+    }
+
+def complete_from_cache(task, cached_path):
+    """Finish a task instantly by publishing a track from the result cache"""
+    global total_downloads
+    publish_folder = os.path.join(DOWNLOAD_FOLDER, task.folder_id)
+    os.makedirs(publish_folder, exist_ok=True)
+    filename = os.path.basename(cached_path)
+    published_path = os.path.join(publish_folder, filename)
+    if not os.path.exists(published_path):  # Playlists can list a video twice
+        link_or_copy(cached_path, published_path)
+    file_expiry.schedule(published_path)
+
+    task.title = os.path.splitext(filename)[0]
+    task.fast_path = 'cache'
+    task.status = 'completed'
+    task.progress = 100
+    task.log(f"⚡ Served from cache: {filename}")
+    download_outcomes.inc(platform=task.source, status='completed')
+    with inflight_lock:
+        record_file(task, f"{task.folder_id}/{filename}")
+    total_downloads += 1
+    if task.parent:
+        settle_playlist(task.parent)
+    notify_task_update()
+
+# Streamed status updates: bumped whenever any task changes
+update_version = 0
+task_updates = threading.Condition()
+SSE_HEARTBEAT = 15  # Seconds between keep-alive comments on idle streams
+SSE_MAX_DURATION = 300  # Streams are closed after this long; EventSource reconnects
+
+def notify_task_update():
+    """Wake up status streams after a task changed"""
+    global update_version
+    with task_updates:
+        update_version += 1
+        task_updates.notify_all()
+
+# In-flight downloads by media key, so identical requests share one download
+inflight_downloads = {}
+inflight_lock = threading.Lock()
+
+# Task fields copied to requests that join an in-flight download
+SHARED_FIELDS = ('progress', 'stage', 'downloaded_bytes', 'total_bytes', 'speed', 'eta',
+                 'transcode_seconds', 'current_file', 'title', 'media', 'playlist_count', 'playlist_current')
+
+def live_members(task):
+    """The task plus the identical requests attached to it, minus cancelled ones"""
+    return [member for member in [task] + task.subscribers if member.status != 'cancelled']
 
-            except Exception as e:
-                active_downloads[task_id].status = 'failed'
-                active_downloads[task_id].error = str(e)
-                active_downloads[task_id].logs.append(f"Error: {str(e)}")
+def share_file(member, rel_path):
+    """Give a subscriber its own hard link to a file published for the primary task"""
+    filename = os.path.basename(rel_path)
+    member_path = f"{member.folder_id}/{filename}"
+    if member_path == rel_path:
+        # Both tasks publish to the same playlist folder
+        return rel_path
+    publish_folder = os.path.join(DOWNLOAD_FOLDER, member.folder_id)
+    os.makedirs(publish_folder, exist_ok=True)
+    link_or_copy(os.path.join(DOWNLOAD_FOLDER, rel_path), os.path.join(publish_folder, filename))
+    file_expiry.schedule(os.path.join(publish_folder, filename))
+    return member_path
 
-            download_history.append(task_id)
+def record_file(task, rel_path):
+    """
+    Add a published file to a task's files. Files of a playlist's videos are
+    also added to the playlist task and everyone attached to it.
+    """
+    if rel_path in task.files:
+        return
+    task.files.append(rel_path)
+    if task.playlist_count > 1:
+        task.title = f"Playlist ({len(task.files)}/{task.playlist_count} ready)"
+    task.log(f"✅ Ready: {os.path.basename(rel_path)}")
 
+    parent = task.parent
+    if parent:
+        for member in live_members(parent):
+            record_file(member, rel_path if member is parent else share_file(member, rel_path))
+
+def attach_subscriber(task):
+    """
+    Attach a new task to an identical in-flight download, if there is one.
+
+    Returns True if the task was attached and must not be queued itself.
+    """
+    if not task.media_key:
+        return False
+    with inflight_lock:
+        primary = inflight_downloads.get(task.media_key)
+        if primary is None:
+            inflight_downloads[task.media_key] = task
+            return False
+
+        task.primary = primary
+        task.status = 'downloading' if primary.process else 'queued'
+        for field in SHARED_FIELDS:
+            setattr(task, field, getattr(primary, field))
+        for rel_path in primary.files:
+            record_file(task, share_file(task, rel_path))
+        task.log("🔗 Joined an identical download that is already in progress")
+        primary.subscribers.append(task)
+        return True
+
+def close_inflight(task):
+    """Stop accepting subscribers for a task and return everyone attached to it"""
+    with inflight_lock:
+        if task.media_key and inflight_downloads.get(task.media_key) is task:
+            del inflight_downloads[task.media_key]
+        return [task] + list(task.subscribers)
+
+# Expanded playlists
+playlist_lock = threading.Lock()
+
+def expand_playlist(task):
+    """
+    List a playlist's videos and queue one child task per video.
+
+    Children run in parallel (at most PLAYLIST_PARALLEL per playlist) and each one
+    can be served from the result cache or join an identical download on its own.
+    Returns False if the playlist couldn't be listed, so it is downloaded in one go.
+    """
+    process = downloader_pool.acquire()
+    task.process = process
+    title, entries = None, []
+    try:
+        process.submit({'op': 'expand', 'url': task.url})
+        for event in process.events():
+            if event['event'] == 'entries':
+                title = event.get('title')
+                entries = event.get('entries') or []
+    except Exception as e:
+        print(f"Playlist listing error: {e}")
+        process.terminate()
+        process.wait()
+    task.process = None
+    downloader_pool.release(process)
+
+    members = live_members(task)
+    if not members:
+        # Cancelled while listing
+        for member in close_inflight(task):
+            download_history.append(member.task_id)
+        return True
+    if not entries:
+        for member in members:
+            member.log("Couldn't list the playlist's videos, downloading it in one go")
+        return False
+
+    # A playlist can list the same video more than once; download it once
+    unique = {}
+    for entry in entries:
+        unique.setdefault(canonical_video_id(entry['url']) or entry['url'], entry)
+    entries = list(unique.values())
+
+    task.children = []
+    for index, entry in enumerate(entries, 1):
+        child = DownloadTask(f"{task.task_id}-{index}", entry['url'], task.quality)
+        child.parent = task
+        child.title = entry.get('title') or ''
+        task.children.append(child)
+    for member in members:
+        member.playlist_count = len(entries)
+        member.title = f"Playlist (0/{len(entries)} ready)"
+        member.log(f"📃 {title or 'Playlist'}: {len(entries)} videos, up to {PLAYLIST_PARALLEL} at once")
+    update_playlist(task)
+    notify_task_update()
+
+    # All children exist before any of them can finish and settle the playlist
+    for child in list(task.children):
+        cached_path = result_cache.get(child.video_id, child.quality)
+        if cached_path:
+            complete_from_cache(child, cached_path)
+        elif not attach_subscriber(child):
+            download_queue.put(child)
+    return True
+
+def update_playlist(parent):
+    """Aggregate an expanded playlist's progress from its children"""
+    children = parent.children
+    if not children:
+        return
+    finished = [child for child in children if child.status in FINISHED_STATUSES]
+    running = [child for child in children if child.status == 'downloading']
+
+    parent.playlist_count = len(children)
+    parent.playlist_current = len(finished)  # Videos finished so far
+    progress = sum(100 if child in finished else child.progress for child in children)
+    parent.progress = min(99, int(progress / len(children)))
+    parent.stage = running[0].stage if running else ''
+    parent.current_file = ', '.join(child.title for child in running if child.title)
+    parent.downloaded_bytes = sum(child.downloaded_bytes for child in running)
+    parent.total_bytes = sum(child.total_bytes for child in running)
+    parent.speed = sum(child.speed or 0 for child in running) or None
+    parent.eta = max((child.eta for child in running if child.eta is not None), default=None)
+    parent.transcode_seconds = sum(child.transcode_seconds for child in children)
+
+    for member in live_members(parent):
+        if member is not parent:
+            for field in SHARED_FIELDS:
+                setattr(member, field, getattr(parent, field))
+
+def settle_playlist(parent):
+    """Finish an expanded playlist once every child has finished"""
+    global total_downloads
+    with playlist_lock:
+        update_playlist(parent)
+        children = parent.children
+        if not children or any(child.status not in FINISHED_STATUSES for child in children):
+            return
+        # Children are only needed until the playlist is done
+        parent.children = []
+
+    failed = [child for child in children if child.status == 'failed']
+    for member in [parent] + parent.subscribers:
+        if member.status == 'cancelled':
+            shutil.rmtree(os.path.join(DOWNLOAD_FOLDER, member.task_id), ignore_errors=True)
+            member.files = []
+        else:
+            for child in failed:
+                member.log(f"❌ Failed: {child.title or child.url} ({child.error})")
+            if member.files:
+                member.status = 'completed'
+                member.progress = 100
+                member.stage = ''
+                # Children already counted the parent's files
+                if member is not parent:
+                    total_downloads += len(member.files)
+            else:
+                member.status = 'failed'
+                member.error = 'Download failed'
+        download_history.append(member.task_id)
+        member.primary = None
+    parent.subscribers = []
+    notify_task_update()
+
+def process_downloads():
+    """Background worker that processes the download queue"""
+    while True:
+        task = download_queue.get()
+        try:
+            run_download(task)
         except Exception as e:
             print(f"Worker error: {e}")
         finally:
-            download_queue.task_done()
+            close_inflight(task)
+            download_queue.task_done(task)
+
+def run_download(task):
+    """Download one queued task, fanning results out to any attached subscribers"""
+    global total_downloads
+    task_id = task.task_id
+    if not live_members(task):
+        close_inflight(task)
+        if task.parent:
+            settle_playlist(task.parent)
+        return
+
+    # The track may have been cached while this task was queued
+    cached_path = result_cache.get(task.video_id, task.quality, count_miss=False)
+    if cached_path:
+        for member in close_inflight(task):
+            if member.status != 'cancelled':
+                complete_from_cache(member, cached_path)
+            elif member.parent:
+                settle_playlist(member.parent)
+            download_history.append(member.task_id)
+        return
+
+    for member in live_members(task):
+        member.status = 'downloading'
+        if member.parent:
+            update_playlist(member.parent)
+    notify_task_update()
+
+    # Playlists are split into one task per video
+    if task.is_playlist and expand_playlist(task):
+        return
+
+    # Create unique staging folder for this download
+    download_path = os.path.join(TEMP_FOLDER, task_id)
+    os.makedirs(download_path, exist_ok=True)
+
+    process = None
+    transcoding = 0  # Transcode slots this task holds
+    try:
+        # Hand the job to a warm downloader process
+        job = {
+            'url': task.url,
+            'quality': task.quality,
+            'threads': FFMPEG_THREADS,
+            'spotify_threads': SPOTIFY_THREADS,
+            'output': download_path,
+            'keep_source': bool(SOURCE_TTL),
+        }
+        # Another quality of this video was downloaded recently: convert its source locally
+        source = source_cache.get(task.video_id)
+        if source:
+            job.update({'op': 'derive', 'source': source[0], 'info': source[1]})
+        # Reuse the info looked up at submission instead of extracting it again
+        looked_up = info_cache.get(task.video_id, count_miss=False) if task.video_id else None
+        if looked_up and looked_up[0]:
+            job['preflight'] = looked_up[0]
+
+        process = downloader_pool.acquire()
+        task.process = process
+        process.submit(job)
+        submitted_at = time.time()
+        succeeded = False
+        fetch = {'started': None, 'ended': False, 'bytes': {}}  # Fetch stage timing and bytes per item
+
+        def end_fetch():
+            """Record the fetch stage once the first item moves on to converting or publishing"""
+            if fetch['started'] and not fetch['ended']:
+                fetch['ended'] = True
+                stage_seconds.observe(time.time() - fetch['started'], stage='fetch')
+
+        def add_file(path, video_id=None, source=None, info=None):
+            """Publish a finished file reported by the downloader"""
+            if source and video_id:
+                try:
+                    source_cache.add(video_id, source, info)
+                except Exception as e:
+                    print(f"Source cache error: {e}")
+            rel_path = publish_file(task_id, path, task.folder_id)
+            if not rel_path:
+                return
+            if video_id:
+                try:
+                    result_cache.add(video_id, task.quality, os.path.join(DOWNLOAD_FOLDER, rel_path))
+                except Exception as e:
+                    print(f"Cache error: {e}")
+            with inflight_lock:
+                for member in live_members(task):
+                    record_file(member, rel_path if member is task else share_file(member, rel_path))
+
+        for event in process.events():
+            if not live_members(task):
+                # Everyone waiting for this download cancelled
+                process.terminate()
+                process.wait()
+                break
 
-# Start background worker
-worker_thread = threading.Thread(target=process_downloads, daemon=True)
-worker_thread.start()
+            if event['event'] == 'done':
+                succeeded = event.get('ok', False)
+                continue
+            if event['event'] == 'file':
+                end_fetch()
+                publish_started = time.time()
+                add_file(event['path'], event.get('id'), event.get('source'), event.get('info'))
+                stage_seconds.observe(time.time() - publish_started, stage='publish')
+                if event.get('derived'):
+                    for member in live_members(task):
+                        member.fast_path = 'derived'
+                notify_task_update()
+                continue
+            if event['event'] == 'transcode':
+                end_fetch()
+                if event.get('state') == 'request':
+                    # Wait for a free slot; the process is paused until it gets one
+                    while not transcoding:
+                        transcoding = transcode_scheduler.acquire(timeout=1, count=event.get('count') or 1)
+                        if not transcoding and not live_members(task):
+                            break
+                    if transcoding:
+                        process.grant_transcode()
+                    if not transcoding:
+                        process.terminate()
+                        process.wait()
+                        break
+                elif transcoding:
+                    transcode_scheduler.release(event.get('seconds'), transcoding)
+                    transcoding = 0
+                    if event.get('seconds') is not None:
+                        stage_seconds.observe(event['seconds'], stage='transcode')
+                    for member in live_members(task):
+                        member.transcode_seconds = round(member.transcode_seconds + (event.get('seconds') or 0), 3)
+                continue
+            if event['event'] == 'progress':
+                if event.get('stage', 'fetch') == 'fetch':
+                    if fetch['started'] is None:
+                        # Time until yt-dlp has extracted the video info and starts fetching
+                        fetch['started'] = time.time()
+                        stage_seconds.observe(fetch['started'] - submitted_at, stage='extract')
+                    fetch['bytes'][event.get('item') or 1] = event.get('downloaded_bytes') or 0
+                else:
+                    end_fetch()
+                for member in live_members(task):
+                    apply_progress(member, event)
+                    if member.parent:
+                        update_playlist(member.parent)
+                notify_task_update()
+                continue
+            if event['event'] != 'log':
+                continue
+
+            for member in live_members(task):
+                member.log(event['line'])
+            notify_task_update()
+
+        if transcoding:
+            # The conversion failed before reporting its time
+            transcode_scheduler.release(count=transcoding)
+            transcoding = 0
+        fetched_bytes.inc(sum(fetch['bytes'].values()), platform=task.source)
+        task.process = None
+        downloader_pool.release(process)
+        process = None
+
+        members = close_inflight(task)
+        for member in members:
+            if member.status == 'cancelled':
+                # Remove the files this task already published
+                shutil.rmtree(os.path.join(DOWNLOAD_FOLDER, member.task_id), ignore_errors=True)
+                member.files = []
+            elif succeeded:
+                member.status = 'completed'
+                member.progress = 100
+
+                # Increment global stats
+                total_downloads += len(member.files) if member.files else 1
+
+                if not member.title and member.files:
+                    member.title = os.path.splitext(os.path.basename(member.files[0]))[0]
+
+                if not member.files:
+                    member.log("Warning: No new files detected")
+            else:
+                member.status = 'failed'
+                member.error = 'Download failed'
+
+    except Exception as e:
+        if transcoding:
+            transcode_scheduler.release(count=transcoding)
+        if process:
+            # State of the process is unknown, don't reuse it
+            task.process = None
+            process.terminate()
+            process.wait()
+            downloader_pool.release(process)
+        members = close_inflight(task)
+        for member in members:
+            if member.status != 'cancelled':
+                member.status = 'failed'
+                member.error = str(e)
+                member.log(f"Error: {str(e)}")
+
+    for member in members:
+        if member.parent:
+            settle_playlist(member.parent)
+    notify_task_update()
+
+    # Anything left in staging is partial or was never published
+    shutil.rmtree(download_path, ignore_errors=True)
+    for member in [task] + task.subscribers:
+        download_history.append(member.task_id)
+        download_outcomes.inc(platform=member.source, status=member.status)
+        # Finished tasks don't need to reference each other anymore
+        member.primary = None
+    task.subscribers = []
 
 # Routes
 @youtube_bp.route('/')
@@ -239,7 +1629,7 @@ def start_download():
     if not url:
         return jsonify({'error': 'URL is required'}), 400
 
-    if quality not in ['128', '192', '256', '320']:
+    if quality not in QUALITIES:
         quality = '320'
 
     if not any(domain in url for domain in ['youtube.com', 'youtu.be', 'spotify.com', 'music.youtube.com']):
@@ -247,34 +1637,258 @@ def start_download():
 
     task_id = str(uuid.uuid4())
     task = DownloadTask(task_id, url, quality)
+
+    # Already converted tracks complete instantly from the cache
+    cached_path = result_cache.get(task.video_id, quality)
+    if cached_path:
+        active_downloads[task_id] = task
+        complete_from_cache(task, cached_path)
+        download_history.append(task_id)
+        return jsonify({
+            'task_id': task_id,
+            'status': 'completed',
+            'message': 'Download served from cache',
+            'quality': quality,
+            'queue_position': 0
+        })
+
+    # Joining an identical download adds no work, anything else has to be admitted
+    if task.media_key not in inflight_downloads:
+        rejection = check_admission(task.source)
+        if rejection:
+            return rejection
+
+        # Look the video up first, so unavailable ones fail now instead of in a worker
+        if task.video_id:
+            info, error = preflight(task.video_id, url)
+            if error:
+                return jsonify({'error': error}), 422
+            if info:
+                task.media = media_summary(info)
+                task.title = task.media['title'] or ''
+
     active_downloads[task_id] = task
+
+    # Identical requests share the download that is already in progress
+    if attach_subscriber(task):
+        persist_task(task)
+        return jsonify({
+            'task_id': task_id,
+            'status': task.status,
+            'message': 'Joined an identical download already in progress',
+            'quality': quality,
+            'media': task.media,
+            'queue_position': download_queue.position(task.primary)
+        })
+
     download_queue.put(task)
+    persist_task(task)
 
     return jsonify({
         'task_id': task_id,
         'status': 'queued',
         'message': 'Download queued successfully',
-        'quality': quality
+        'quality': quality,
+        'media': task.media,
+        'queue_position': download_queue.position(task),
+        'estimated_wait': round(download_queue.estimate_wait(task.source))
     })
 
-@youtube_bp.route('/api/status/<task_id>')
-def get_status(task_id):
-    if task_id not in active_downloads:
-        return jsonify({'error': 'Task not found'}), 404
+def check_admission(source):
+    """
+    Refuse new work when the service is saturated, so clients are told to come
+    back later instead of waiting into a proxy timeout.
 
-    task = active_downloads[task_id]
-    return jsonify({
-        'task_id': task_id,
+    Returns an error response (503 when the disk is nearly full, 429 when the
+    queue is too long) with Retry-After, or None if the download can be queued.
+    """
+    try:
+        free_bytes = shutil.disk_usage(DOWNLOAD_FOLDER).free
+    except OSError:
+        free_bytes = MIN_FREE_BYTES
+    if free_bytes < MIN_FREE_BYTES:
+        # Space comes back as finished files expire
+        retry_after = max(FILE_TTL, 30)
+        response = jsonify({
+            'error': f'The server is low on disk space, please try again in {retry_after} seconds',
+            'retry_after': retry_after
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    queue_depth = download_queue.depth()
+    estimated_wait = download_queue.estimate_wait(source)
+    if queue_depth < MAX_QUEUE_DEPTH and estimated_wait <= MAX_WAIT_SECONDS:
+        return None
+
+    # Roughly how long until the queue is back under its limits
+    overflow = max(queue_depth - MAX_QUEUE_DEPTH + 1, 0)
+    retry_after = int(max(estimated_wait - MAX_WAIT_SECONDS,
+                          estimated_wait * overflow / max(queue_depth, 1), 10))
+    response = jsonify({
+        'error': f'Too many downloads are queued, please try again in {retry_after} seconds',
+        'retry_after': retry_after,
+        'queue_position': queue_depth + 1,
+        'estimated_wait': round(estimated_wait)
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def task_state(task):
+    """Status fields of a task (everything except files and logs)"""
+    return {
         'status': task.status,
         'progress': task.progress,
         'current_file': task.current_file,
+        'stage': task.stage,
+        'downloaded_bytes': task.downloaded_bytes,
+        'total_bytes': task.total_bytes,
+        'speed': task.speed,
+        'eta': task.eta,
+        'transcode_seconds': task.transcode_seconds,
         'title': task.title,
+        'media': task.media,
         'playlist_count': task.playlist_count,
         'playlist_current': task.playlist_current,
+        'error': task.error,
+        'fast_path': task.fast_path,
+        'queue_position': download_queue.position(task.primary or task) if task.status == 'queued' else 0
+    }
+
+@youtube_bp.route('/api/status/<task_id>')
+def get_status(task_id):
+    if task_id not in active_downloads:
+        return jsonify({'error': 'Task not found'}), 404
+
+    task = active_downloads[task_id]
+    status = task_state(task)
+    status.update({
+        'task_id': task_id,
+        'url': task.url,
         'files': task.files,
-        'logs': task.logs[-20:],
-        'error': task.error
+        'logs': task.recent_logs(20),
+        'log_cursor': task.log_total
+    })
+    return jsonify(status)
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_updates(task_ids):
+    """
+    Generate Server-Sent Events for a set of tasks.
+
+    The first 'update' for a task on each connection is a snapshot ('snapshot':
+    true) with its full status, all its files and recent logs, which replaces what
+    the client has, so a reconnect doesn't repeat them. Later ones only carry
+    changed fields plus 'new_files' and 'new_logs'. The stream sends 'end' once
+    every task has finished, and 'stats' when the global download count changes
+    (checked when a task finishes or every SSE_HEARTBEAT, not on every wake).
+    """
+    sent_states = {}  # task_id -> last state sent
+    sent_files = {}  # task_id -> number of files sent
+    log_cursors = {}  # task_id -> log_total already sent
+    sent_total = None
+    total_checked = 0
+    seen_version = -1
+    started = time.time()
+    last_message = time.time()
+
+    while task_ids and time.time() - started < SSE_MAX_DURATION:
+        with task_updates:
+            if update_version == seen_version:
+                task_updates.wait(timeout=SSE_HEARTBEAT)
+            seen_version = update_version
+
+        messages = []
+        finished = False
+        for task_id in list(task_ids):
+            task = active_downloads.get(task_id)
+            if task is None:
+                messages.append(sse_message('gone', {'task_id': task_id}))
+                task_ids.remove(task_id)
+                continue
+
+            state = task_state(task)
+            previous = sent_states.get(task_id)
+            delta = {key: value for key, value in state.items()
+                     if previous is None or previous.get(key) != value}
+
+            files = task.files
+            if len(files) > sent_files.get(task_id, 0):
+                delta['new_files'] = files[sent_files.get(task_id, 0):]
+            if task_id in log_cursors:
+                new_logs = task.logs_since(log_cursors[task_id])
+            else:
+                new_logs = task.recent_logs(50)  # As many as script.js keeps
+                delta['snapshot'] = True
+            if new_logs:
+                delta['new_logs'] = new_logs
+
+            if delta:
+                delta['task_id'] = task_id
+                messages.append(sse_message('update', delta))
+            sent_states[task_id] = state
+            sent_files[task_id] = len(files)
+            log_cursors[task_id] = task.log_total
+
+            if task.status in ('completed', 'failed', 'cancelled'):
+                task_ids.remove(task_id)
+                finished = True
+
+        # The total may come from the state database, so it isn't read on every wake
+        if finished or time.time() - total_checked >= SSE_HEARTBEAT:
+            total_checked = time.time()
+            total = total_download_count()
+            if total != sent_total:
+                sent_total = total
+                messages.append(sse_message('stats', {'total_downloads': total}))
+
+        if messages:
+            yield ''.join(messages)
+            last_message = time.time()
+        elif time.time() - last_message >= SSE_HEARTBEAT:
+            yield ': keep-alive\n\n'
+            last_message = time.time()
+
+    if not task_ids:
+        yield sse_message('end', {})
+
+def sse_response(task_ids):
+    """The event stream, or a 503 when too many long-lived responses are open (script.js then polls)"""
+    if not long_responses.acquire():
+        return busy_response()
+    response = Response(stream_updates(task_ids), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Don't let nginx buffer the stream
     })
+    response.call_on_close(long_responses.release)
+    return response
+
+@youtube_bp.route('/api/events/<task_id>')
+def stream_task(task_id):
+    """Stream status changes of one task as Server-Sent Events"""
+    if task_id not in active_downloads:
+        return jsonify({'error': 'Task not found'}), 404
+    return sse_response([task_id])
+
+@youtube_bp.route('/api/events')
+def stream_tasks():
+    """Stream status changes of several tasks (?tasks=id1,id2) over one connection"""
+    task_ids = [task_id for task_id in request.args.get('tasks', '').split(',') if task_id]
+    if not task_ids:
+        return jsonify({'error': 'No tasks given'}), 400
+    return sse_response(task_ids[:50])
+
+def stop_download(task):
+    """Terminate the downloader process working on a task, if any"""
+    if task.process:
+        try:
+            task.process.terminate()
+        except:
+            pass
 
 @youtube_bp.route('/api/cancel/<task_id>', methods=['POST'])
 def cancel_download(task_id):
@@ -289,11 +1903,19 @@ def cancel_download(task_id):
     task.status = 'cancelled'
     task.error = 'Cancelled by user'
 
-    if task.process:
-        try:
-            task.process.terminate()
-        except:
-            pass
+    # Only stop the download if nobody else is waiting for it
+    primary = task.primary or task
+    if not live_members(primary):
+        stop_download(primary)
+        if primary.children:
+            for child in primary.children:
+                if child.status not in FINISHED_STATUSES:
+                    child.status = 'cancelled'
+                    child_primary = child.primary or child
+                    if not live_members(child_primary):
+                        stop_download(child_primary)
+            settle_playlist(primary)
+    notify_task_update()
 
     return jsonify({
         'task_id': task_id,
@@ -317,9 +1939,59 @@ def list_downloads():
 @youtube_bp.route('/api/stats')
 def get_stats():
     return jsonify({
-        'total_downloads': total_downloads
+        'total_downloads': total_download_count()
     })
 
+@youtube_bp.route('/api/queue')
+def get_queue_stats():
+    """Queue depth, wait times and worker slot utilization for sizing the pool"""
+    stats = download_queue.stats()
+    stats['transcode'] = transcode_scheduler.stats()
+    stats['file_expiry'] = file_expiry.stats()
+    stats['task_store'] = active_downloads.stats()
+    return jsonify(stats)
+
+@youtube_bp.route('/api/cache')
+def get_cache_stats():
+    """Hit rate, bytes saved and evictions of the converted track and source caches"""
+    stats = result_cache.stats()
+    stats['sources'] = source_cache.stats()
+    stats['info'] = info_cache.stats()
+    return jsonify(stats)
+
+def metrics():
+    """Metric families of this process as (name, type, help, samples), rendered by /metrics in main.py"""
+    queue = download_queue.stats()
+    cache = result_cache.stats()
+    sources = source_cache.stats()
+    info = info_cache.stats()
+    transcode = transcode_scheduler.stats()
+    return [
+        ('cub_queue_depth', 'gauge', 'Downloads waiting for a worker',
+         [('cub_queue_depth', {}, queue['queue_depth'])]),
+        ('cub_active_workers', 'gauge', 'Download workers running a download',
+         [('cub_active_workers', {}, queue['busy_workers'])]),
+        ('cub_worker_slots', 'gauge', 'Download workers',
+         [('cub_worker_slots', {}, WORKER_COUNT)]),
+        ('cub_active_transcodes', 'gauge', 'Conversions running',
+         [('cub_active_transcodes', {}, transcode['running'])]),
+        ('cub_stage_seconds', 'histogram', 'Time spent in each download stage',
+         stage_seconds.samples('cub_stage_seconds')),
+        ('cub_fetched_bytes_total', 'counter', 'Bytes fetched from the source platforms',
+         fetched_bytes.samples('cub_fetched_bytes_total')),
+        ('cub_served_bytes_total', 'counter', 'Bytes of finished files sent to clients',
+         served_bytes.samples('cub_served_bytes_total')),
+        ('cub_cache_hits_total', 'counter', 'Downloads answered from a cache',
+         [('cub_cache_hits_total', {'cache': 'result'}, cache['hits']),
+          ('cub_cache_hits_total', {'cache': 'source'}, sources['derived']),
+          ('cub_cache_hits_total', {'cache': 'info'}, info['hits'])]),
+        ('cub_cache_misses_total', 'counter', 'Cache lookups that missed',
+         [('cub_cache_misses_total', {'cache': 'result'}, cache['misses']),
+          ('cub_cache_misses_total', {'cache': 'info'}, info['misses'])]),
+        ('cub_downloads_total', 'counter', 'Finished downloads by platform and status',
+         download_outcomes.samples('cub_downloads_total')),
+    ]
+
 @youtube_bp.route('/download/<path:filename>')
 def download_file(filename):
     try:
@@ -330,45 +2002,261 @@ def download_file(filename):
         if not file_path.startswith(download_folder_abs + os.sep) and file_path != download_folder_abs:
             return jsonify({'error': 'Invalid file path'}), 403
 
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+        if os.path.isfile(file_path):
+            started = time.time()
+            response = serve_held(file_expiry, file_path, DOWNLOAD_FOLDER, ACCEL_REDIRECT_PREFIX)
+            stage_seconds.observe(time.time() - started, stage='serve')
+            # With X-Accel-Redirect nginx sends the body
+            served_bytes.inc(os.path.getsize(file_path) if X_ACCEL_REDIRECT else response.content_length or 0,
+                             kind='file')
+            return response
         else:
             return jsonify({'error': 'File not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def cleanup_old_files():
-    """Background task to clean up files older than 30 seconds"""
+def stream_archive(task):
+    """
+    Generate a stored (uncompressed) ZIP of a task's files.
+
+    Files are added as they are published, so a running playlist starts streaming
+    right away; the archive is finished once the task is done. Memory use is one
+    chunk regardless of archive size.
+    """
+    sink = ZipStream()
+    added = 0
+    names = set()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        while True:
+            files = list(task.files)
+            for rel_path in files[added:]:
+                added += 1
+                file_path = os.path.join(DOWNLOAD_FOLDER, rel_path)
+                if not os.path.isfile(file_path):
+                    continue
+
+                # Playlists can contain two tracks with the same title
+                name = os.path.basename(rel_path)
+                base, ext = os.path.splitext(name)
+                counter = 1
+                while name in names:
+                    counter += 1
+                    name = f"{base} ({counter}){ext}"
+                names.add(name)
+
+                entry = zipfile.ZipInfo.from_file(file_path, arcname=name)
+                entry.compress_type = zipfile.ZIP_STORED
+                with open(file_path, 'rb') as source, archive.open(entry, 'w') as target:
+                    while True:
+                        chunk = source.read(ARCHIVE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield sink.take()
+                yield sink.take()
+
+            if task.status in FINISHED_STATUSES and added >= len(task.files):
+                break
+            # Wait for the next file of a running task
+            with task_updates:
+                task_updates.wait(timeout=SSE_HEARTBEAT)
+    yield sink.take()
+
+@youtube_bp.route('/download-archive/<task_id>')
+def download_archive(task_id):
+    """Stream all of a task's files as one ZIP, starting before the task has finished"""
+    task = active_downloads.get(task_id)
+    if task is None:
+        return jsonify({'error': 'Task not found'}), 404
+    if task.status in FINISHED_STATUSES and not task.files:
+        return jsonify({'error': 'No files to download'}), 404
+
+    # Playlist titles are progress text like "Playlist (3/10 ready)"
+    title = task.title
+    if not title or title.startswith('Playlist ('):
+        title = 'playlist'
+
+    if not long_responses.acquire():
+        return busy_response()
+
+    # The task's files must outlive the stream
+    folder = os.path.join(DOWNLOAD_FOLDER, task.folder_id)
+    file_expiry.acquire(folder)
+    response = Response(count_served(stream_archive(task), served_bytes, stage_seconds), mimetype='application/zip', headers={
+        'Content-Disposition': attachment_header(f"{title}.zip"),
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(lambda: file_expiry.release(folder))
+    response.call_on_close(long_responses.release)
+    return response
+
+def evict_expired():
+    """Background task that forgets finished tasks and cached sources past their TTL"""
     while True:
         try:
-            cutoff_time = time.time() - 30  # 30 seconds ago
-
-            if os.path.exists(DOWNLOAD_FOLDER):
-                for root, dirs, files in os.walk(DOWNLOAD_FOLDER):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        try:
-                            if os.path.getmtime(file_path) < cutoff_time:
-                                os.remove(file_path)
-                                print(f"Cleaned up old file: {file}")
-                        except Exception as e:
-                            print(f"Error cleaning up {file}: {e}")
-
-                # Remove empty directories
-                for root, dirs, files in os.walk(DOWNLOAD_FOLDER, topdown=False):
-                    for dir_name in dirs:
-                        dir_path = os.path.join(root, dir_name)
-                        try:
-                            if not os.listdir(dir_path):
-                                os.rmdir(dir_path)
-                                print(f"Removed empty directory: {dir_name}")
-                        except Exception as e:
-                            pass
+            active_downloads.evict()
+            state_store.evict(TASK_TTL)
+            source_cache.evict()
         except Exception as e:
-            print(f"Cleanup error: {e}")
+            print(f"Eviction error: {e}")
+
+        time.sleep(15)
+
+def clear_staging(keep=()):
+    """
+    Remove staging folders left behind by a previous run. Folders of tasks in
+    `keep` (unfinished, so the previous process may still be running them until
+    recover_jobs() takes them over) and recently used ones are left alone.
+    """
+    cutoff = time.time() - WORKER_TIMEOUT
+    for name in os.listdir(TEMP_FOLDER):
+        path = os.path.join(TEMP_FOLDER, name)
+        try:
+            if name in keep or os.path.getmtime(path) > cutoff:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+# Saved state sync
+worker_id = None  # This process in the state store, set by start_background()
+stopping = threading.Event()  # Set by stop_background()
+synced_total = 0  # Part of total_downloads already added to the state store
+
+def sync_state():
+    """
+    Background task that writes changed tasks to the state store, sends
+    heartbeats and re-queues the jobs of a previous process once it is gone.
 
-        time.sleep(15)  # Wait 15 seconds before next cleanup
+    A reload starts the new process before the old one has exited, so the old
+    jobs are only taken over after its heartbeats stop (or it unregisters).
+    """
+    global synced_total
+    written = {}  # task_id -> record last written
+    settled = set()  # Finished tasks whose final record has been written
+    seen_version = -1
+    last_heartbeat = 0
+    while not stopping.is_set():
+        with task_updates:
+            if update_version == seen_version:
+                task_updates.wait(timeout=WORKER_HEARTBEAT)
+            seen_version = update_version
+        if stopping.is_set():
+            break  # stop_background() writes the final states
+
+        try:
+            tasks = active_downloads.items()
+            changed = []
+            for task_id, task in tasks:
+                if task_id in settled:
+                    continue
+                record = task_record(task)
+                if written.get(task_id) != record:
+                    changed.append((task_id, record))
+                elif record['status'] in FINISHED_STATUSES:
+                    settled.add(task_id)
+                    del written[task_id]
+            if changed:
+                state_store.save_tasks(worker_id, changed)
+                written.update(changed)
+
+            count = total_downloads - synced_total
+            if count:
+                state_store.add_total(count)
+                synced_total += count
+
+            if time.time() - last_heartbeat >= WORKER_HEARTBEAT:
+                last_heartbeat = time.time()
+                state_store.heartbeat(worker_id)
+                recover_jobs()
+                # Forget tasks the task store has evicted
+                task_ids = {task_id for task_id, task in tasks}
+                settled &= task_ids
+                for task_id in set(written) - task_ids:
+                    del written[task_id]
+        except Exception as e:
+            print(f"State sync error: {e}")
+
+        time.sleep(STATE_SYNC_INTERVAL)  # Coalesce bursts of progress updates into one write
+
+def recover_jobs():
+    """Queue the unfinished jobs of a previous process that stopped, e.g. before a restart"""
+    for task_id, record in state_store.claim_orphans(worker_id, WORKER_TIMEOUT):
+        if task_id in active_downloads:
+            continue
+        # The previous process is gone, so its partial files can go
+        shutil.rmtree(os.path.join(TEMP_FOLDER, task_id), ignore_errors=True)
+        task = DownloadTask(task_id, record['url'], record['quality'])
+        for line in record['logs']:
+            task.log(line)
+        active_downloads[task_id] = task
+        task.log("♻️ Restarted after the server restarted")
+        if not attach_subscriber(task):
+            download_queue.put(task)
+        print(f"Recovered download {task_id}")
+    notify_task_update()
+
+background_pid = None  # Process the background threads were started in
+worker_threads = []
+background_lock = threading.Lock()
+
+def start_background():
+    """
+    Start the downloader pool and background threads of this process, once.
+
+    Threads don't survive a fork, so gunicorn workers call this after loading
+    the app (post_worker_init in gunicorn_config.py); requests call it too, in
+    case a process was forked without it.
+    """
+    global background_pid, worker_id
+    if background_pid == os.getpid():
+        return
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        background_pid = os.getpid()
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    try:
+        state_store.register(worker_id)
+        keep = state_store.unfinished_task_ids()
+    except Exception as e:
+        print(f"State store error: {e}")
+        keep = set()
+    clear_staging(keep)
+    file_expiry.load()
+
+    threading.Thread(target=downloader_pool.prewarm, daemon=True).start()
+    threading.Thread(target=preflight_pool.prewarm, daemon=True).start()
+    for worker_index in range(WORKER_COUNT):
+        worker_thread = threading.Thread(target=process_downloads, name=f'music-worker-{worker_index}', daemon=True)
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+    threading.Thread(target=file_expiry.run, name='music-file-expiry', daemon=True).start()
+    threading.Thread(target=evict_expired, name='music-eviction', daemon=True).start()
+    threading.Thread(target=sync_state, name='music-state-sync', daemon=True).start()
+    atexit.register(stop_background)
+
+def stop_background():
+    """
+    Stop this process's downloader processes and write the final task states,
+    so the next start queues the unfinished jobs again.
+
+    The states are taken before the processes are stopped, otherwise the jobs
+    they were running would be saved as failed. Running processes must be gone
+    before the next start reuses their staging folders.
+    """
+    stopping.set()
+    records = [(task_id, task_record(task)) for task_id, task in active_downloads.items()
+               if task.status not in FINISHED_STATUSES]
+    downloader_pool.close()
+    preflight_pool.close()
+    try:
+        state_store.save_tasks(worker_id, records)
+        state_store.unregister(worker_id)
+    except Exception as e:
+        print(f"State store error: {e}")
 
-# Start cleanup worker
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-cleanup_thread.start()
+@youtube_bp.before_app_request
+def ensure_background():
+    start_background()
@@ -1,41 +1,196 @@
 import yt_dlp
+from yt_dlp.postprocessor import PostProcessor
+import io
+import json
 import os
+import re
+import shutil
+import sqlite3
 import sys
 import subprocess
+import threading
+import time
 
 def is_spotify_url(url):
     """Check if URL is from Spotify"""
     return 'spotify.com' in url
 
-def download_spotify(url, output_path='downloads', quality='320'):
-    """Download from Spotify using spotdl"""
+# 'original' keeps the source audio stream (remuxed, not re-encoded) instead of converting to MP3
+PASSTHROUGH_QUALITY = 'original'
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.opus')
+
+def list_audio_files(output_path):
+    """Return the set of audio files directly inside output_path"""
+    return {os.path.join(output_path, name) for name in os.listdir(output_path) if name.endswith(AUDIO_EXTENSIONS)}
+
+# Databases written at runtime live here, as for the app (shared/state.py)
+DATA_DIR = os.environ.get('CUB_DATA_DIR', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'var'))
+
+# Spotify track ID -> matched YouTube URL, shared by all downloader processes
+SPOTIFY_MATCH_DB = os.path.join(DATA_DIR, 'spotify_matches.db')
+
+# spotdl prints this once a track is downloaded, converted and tagged
+SPOTDL_DOWNLOADED_PATTERN = re.compile(r'Downloaded "(.+)": (\S+)')
+
+def open_match_db():
+    """Open (and create if needed) the Spotify -> YouTube match cache"""
+    os.makedirs(os.path.dirname(SPOTIFY_MATCH_DB), exist_ok=True)
+    db = sqlite3.connect(SPOTIFY_MATCH_DB, timeout=10)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS matches ('
+               'track_id TEXT PRIMARY KEY, youtube_url TEXT NOT NULL, updated_at REAL NOT NULL)')
+    return db
+
+def load_matches(db, track_ids):
+    """Return {track_id: youtube_url} for the tracks that were matched before"""
+    matches = {}
+    track_ids = list(track_ids)
+    for start in range(0, len(track_ids), 500):  # SQLite limits query parameters
+        chunk = track_ids[start:start + 500]
+        rows = db.execute(f"SELECT track_id, youtube_url FROM matches WHERE track_id IN ({','.join('?' * len(chunk))})", chunk)
+        matches.update(rows)
+    return matches
+
+def save_match(db, track_id, youtube_url):
+    with db:
+        db.execute('INSERT OR REPLACE INTO matches VALUES (?, ?, ?)', (track_id, youtube_url, time.time()))
+
+def list_spotify_tracks(url, output_path):
+    """
+    Fetch the tracks of a Spotify URL with `spotdl save` (metadata only, no YouTube search).
+
+    Returns a list of spotdl song dicts, or [] if the list couldn't be fetched.
+    """
+    save_file = os.path.join(output_path, 'tracks.spotdl')
+    try:
+        result = subprocess.run(["spotdl", "save", url, "--save-file", save_file],
+                                capture_output=True, text=True)
+        if result.returncode != 0 or not os.path.exists(save_file):
+            print(result.stdout)
+            return []
+        with open(save_file, encoding='utf-8') as f:
+            return [song for song in json.load(f) if song.get('song_id') and song.get('url')]
+    except Exception as e:
+        print(f"Couldn't list Spotify tracks: {e}")
+        return []
+    finally:
+        if os.path.exists(save_file):
+            os.remove(save_file)
+
+def download_spotify(url, output_path='downloads', quality='320', threads=None, emit=None, spotify_threads=None,
+                     wait_for_transcode=None):
+    """
+    Download from Spotify using spotdl
+
+    Tracks whose YouTube match is in the match cache are passed to spotdl as
+    "youtube_url|spotify_url" queries, so spotdl skips its search for them.
+    spotdl's output is streamed line by line: each finished track is reported
+    as a 'file' event and a 'progress' event as soon as spotdl prints it.
+
+    spotdl runs its own ffmpeg conversions, up to one per thread, so with
+    wait_for_transcode the run holds one transcode slot per spotdl thread.
+
+    Args:
+        spotify_threads: Tracks spotdl resolves and downloads at once (None = spotdl default)
+        wait_for_transcode: Blocks until the web app grants the given number of transcode slots
+    """
+    if quality == PASSTHROUGH_QUALITY:
+        wait_for_transcode = None  # Remuxing is cheap, no need to wait for a slot
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
+    # spotdl runs as a separate program, so finished files are found by
+    # checking the output folder each time it reports a downloaded track
+    seen_files = list_audio_files(output_path)
+
+    def report_new_files():
+        for path in sorted(list_audio_files(output_path) - seen_files):
+            seen_files.add(path)
+            if emit:
+                emit('file', path=path, title=os.path.splitext(os.path.basename(path))[0])
+
+    holding_slot = False
     try:
         print(f"Processing Spotify URL: {url}\n")
 
+        # Look up previously matched tracks, so only new ones are searched on YouTube
+        songs = list_spotify_tracks(url, output_path)
+        db = open_match_db()
+        matches = load_matches(db, [song['song_id'] for song in songs])
+        if songs:
+            queries = [f"{matches[song['song_id']]}|{song['url']}" if song['song_id'] in matches else song['url']
+                       for song in songs]
+            print(f"{len(songs)} tracks, {len(matches)} already matched to YouTube\n")
+        else:
+            queries = [url]
+        # spotdl's "Downloaded" line shows "<main artist> - <name>" (its display_name)
+        songs_by_name = {f"{song.get('artist')} - {song.get('name')}": song for song in songs}
+
         # Check for YouTube cookies file
         cookies_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'youtube_cookies.txt')
 
         # Use system spotdl (works on both Windows and Linux)
-        cmd = ["spotdl", url, "--output", output_path, "--format", "mp3", "--bitrate", f"{quality}k"]
+        cmd = ["spotdl", "download", *queries, "--output", output_path, "--simple-tui"]
+        if quality == PASSTHROUGH_QUALITY:
+            # YouTube's best audio stream is Opus; copy it without re-encoding
+            cmd.extend(["--format", "opus", "--bitrate", "disable"])
+        else:
+            cmd.extend(["--format", "mp3", "--bitrate", f"{quality}k"])
 
         # Add cookies if available (spotdl uses yt-dlp internally)
         if os.path.exists(cookies_file):
             cmd.extend(["--cookie-file", cookies_file])
 
-        result = subprocess.run(
+        # Resolve and download several tracks at once
+        if spotify_threads:
+            cmd.extend(["--threads", str(spotify_threads)])
+
+        # Limit ffmpeg CPU usage per task
+        if threads:
+            cmd.extend(["--ffmpeg-args", f"-threads {threads}"])
+
+        # Unbuffered, unwrapped output so every track is seen as soon as it's done
+        env = dict(os.environ, PYTHONUNBUFFERED='1', COLUMNS='1000')
+        if wait_for_transcode:
+            wait_for_transcode(spotify_threads or 1)
+            holding_slot = True
+        process = subprocess.Popen(
             cmd,
-            capture_output=True,
-            text=True
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            bufsize=1,
+            env=env
         )
 
-        print(result.stdout)
-        if result.stderr:
-            print(result.stderr)
+        count = max(len(songs), 1)
+        done = 0
+        for line in process.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            print(line)
 
-        if result.returncode == 0:
+            match = SPOTDL_DOWNLOADED_PATTERN.search(line)
+            if not match:
+                continue
+            done += 1
+            name, download_url = match.groups()
+            song = songs_by_name.get(name)
+            if song and 'youtube.com' in download_url and matches.get(song['song_id']) != download_url:
+                save_match(db, song['song_id'], download_url)
+            report_new_files()
+            if emit:
+                emit('progress', stage='tag', state='finished', item=min(done, count), count=count, title=name)
+
+        process.wait()
+        report_new_files()
+        db.close()
+
+        if process.returncode == 0:
             print("\nSpotify download complete!")
             return True
         else:
@@ -44,22 +199,13 @@ def download_spotify(url, output_path='downloads', quality='320'):
     except Exception as e:
         print(f"Error: {e}")
         return False
+    finally:
+        if holding_slot:
+            # The run includes downloads, so no conversion time is reported
+            emit('transcode', state='finished')
 
-def download_mp3(url, output_path='downloads', quality='320'):
-    """
-    Download YouTube video or playlist as MP3 at specified quality
-
-    Args:
-        url: YouTube video or playlist URL
-        output_path: Directory to save the MP3 files
-        quality: Audio quality in kbps (128, 192, 256, or 320)
-    """
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-
-    # Clean up URL - remove radio/autoplay playlist parameters
-    # Only keep explicit playlist parameter
-    import re
+def clean_url(url):
+    """Remove radio/autoplay playlist parameters, only keeping explicit playlists"""
     from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
     try:
@@ -80,6 +226,10 @@ def download_mp3(url, output_path='downloads', quality='320'):
     except:
         pass  # If URL parsing fails, continue with original URL
 
+    return url
+
+def build_ydl_template():
+    """Build the yt-dlp options shared by every download (no per-job settings)"""
     # FFmpeg will be auto-detected from system PATH on Linux, or use Windows path if exists
     ffmpeg_path = None
     if os.name == 'nt':  # Windows
@@ -90,19 +240,8 @@ def download_mp3(url, output_path='downloads', quality='320'):
     # Check for YouTube cookies file
     cookies_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'youtube_cookies.txt')
 
-    ydl_opts = {
+    return {
         'format': 'bestaudio/best',
-        'postprocessors': [
-            {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': quality,
-            },
-            {
-                'key': 'FFmpegMetadata',
-                'add_metadata': True,
-            },
-        ],
         'ffmpeg_location': ffmpeg_path if ffmpeg_path else None,
         'cookiefile': cookies_file if os.path.exists(cookies_file) else None,
         'extractor_args': {
@@ -111,15 +250,177 @@ def download_mp3(url, output_path='downloads', quality='320'):
             }
         },
         'remote_components': ['ejs:github'],
-        'outtmpl': os.path.join(output_path, '%(title)s.%(ext)s'),
         'quiet': False,
         'no_warnings': False,
         'ignoreerrors': True,  # Continue on download errors in playlists
     }
 
+def build_ydl_opts(template, output_path='downloads', quality='320', threads=None):
+    """Apply per-job settings to a copy of the options from build_ydl_template()"""
+    ydl_opts = dict(template)
+    if quality == PASSTHROUGH_QUALITY:
+        # Keep the source codec: m4a is left as-is, Opus in WebM is remuxed to .opus
+        extract_audio = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}
+    else:
+        extract_audio = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': quality}
+    ydl_opts['postprocessors'] = [
+        extract_audio,
+        {
+            'key': 'FFmpegMetadata',
+            'add_metadata': True,
+        },
+    ]
+    ydl_opts['outtmpl'] = os.path.join(output_path, '%(title)s.%(ext)s')
+
+    # Limit ffmpeg CPU usage per task
+    if threads:
+        ydl_opts['postprocessor_args'] = {'ffmpeg': ['-threads', str(threads)]}
+
+    return ydl_opts
+
+# Info fields saved with a kept source stream: enough to name and tag files converted from it later
+SOURCE_INFO_FIELDS = ('id', 'title', 'track', 'artist', 'artists', 'creator', 'uploader', 'uploader_id',
+                      'album', 'album_artist', 'genre', 'composer', 'track_number', 'disc_number',
+                      'release_date', 'release_year', 'upload_date', 'description', 'webpage_url', 'duration')
+
+class FileReadyPP(PostProcessor):
+    """
+    Reports each finished file (converted, tagged and moved) as a 'file' event.
+
+    With keep_source, the downloaded stream a file was converted from is kept
+    and reported as 'source', together with the 'info' needed to convert it again.
+    """
+    def __init__(self, emit, keep_source=False, derived=False):
+        super().__init__()
+        self.emit = emit
+        self.keep_source = keep_source
+        self.derived = derived
+        self.sources = {}  # Video ID -> downloaded stream
+
+    def record_source(self, d):
+        """Progress hook that remembers where each video's stream was downloaded to"""
+        video_id = (d.get('info_dict') or {}).get('id')
+        if d['status'] == 'finished' and video_id:
+            self.sources[video_id] = d.get('filename')
+
+    def run(self, info):
+        fields = {}
+        if self.derived:
+            fields['derived'] = True
+        source = self.sources.pop(info.get('id'), None)
+        if self.keep_source and source and os.path.exists(source) and source != info['filepath']:
+            fields['source'] = source
+            fields['info'] = {key: info[key] for key in SOURCE_INFO_FIELDS if info.get(key) is not None}
+        self.emit('file', path=info['filepath'], id=info.get('id'), title=info.get('title'), **fields)
+        return [], info
+
+# Post-processors reported as progress stages
+PP_STAGES = {
+    'ExtractAudio': 'transcode',
+    'Metadata': 'tag',
+}
+
+def make_progress_hooks(emit, min_interval=0.5, wait_for_transcode=None):
+    """
+    Build yt-dlp progress and post-processor hooks that emit compact 'progress' events.
+
+    Download updates are throttled to one every min_interval seconds per item.
+    If wait_for_transcode is given, it is called before each audio conversion and
+    must block until the conversion may start; each conversion's duration is then
+    reported as a 'transcode' event.
+    """
+    last_emit = {'time': 0}
+    transcode_started = {'time': None}
+
+    def item_fields(info):
+        return {
+            'item': info.get('playlist_index') or 1,
+            'count': info.get('n_entries') or info.get('playlist_count') or 1,
+            'title': info.get('title'),
+        }
+
+    def progress_hook(d):
+        now = time.time()
+        if d['status'] == 'downloading' and now - last_emit['time'] < min_interval:
+            return
+        if d['status'] not in ('downloading', 'finished'):
+            return
+        last_emit['time'] = now
+        emit('progress', stage='fetch',
+             downloaded_bytes=d.get('downloaded_bytes'),
+             total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+             speed=d.get('speed'),
+             eta=d.get('eta'),
+             **item_fields(d.get('info_dict') or {}))
+
+    def postprocessor_hook(d):
+        stage = PP_STAGES.get(d.get('postprocessor'))
+        if not stage or d['status'] not in ('started', 'finished'):
+            return
+        if stage == 'transcode' and wait_for_transcode:
+            # yt-dlp can report the same stage more than once; ask for one slot per conversion
+            if d['status'] == 'started' and transcode_started['time'] is None:
+                wait_for_transcode()
+                transcode_started['time'] = time.time()
+            elif d['status'] == 'finished' and transcode_started['time'] is not None:
+                emit('transcode', state='finished', seconds=round(time.time() - transcode_started['time'], 3))
+                transcode_started['time'] = None
+        emit('progress', stage=stage, state=d['status'], **item_fields(d.get('info_dict') or {}))
+
+    return progress_hook, postprocessor_hook
+
+def add_event_hooks(ydl_opts, quality, emit, wait_for_transcode=None):
+    """Report progress through emit() instead of yt-dlp's console progress"""
+    if quality == PASSTHROUGH_QUALITY:
+        wait_for_transcode = None  # Remuxing is cheap, no need to wait for a slot
+    progress_hook, postprocessor_hook = make_progress_hooks(emit, wait_for_transcode=wait_for_transcode)
+    ydl_opts['progress_hooks'] = [progress_hook]
+    ydl_opts['postprocessor_hooks'] = [postprocessor_hook]
+    ydl_opts['noprogress'] = True
+
+def download_mp3(url, output_path='downloads', quality='320', threads=None, template=None, emit=None,
+                 wait_for_transcode=None, keep_source=False, info=None):
+    """
+    Download YouTube video or playlist as MP3 at specified quality
+
+    Args:
+        url: YouTube video or playlist URL
+        output_path: Directory to save the MP3 files
+        quality: Audio quality in kbps (128, 192, 256, or 320), or 'original' to keep the source audio
+        threads: Max threads for the ffmpeg conversion (None = ffmpeg default)
+        template: Prebuilt options from build_ydl_template() (built here if None)
+        emit: Optional event callback, called as emit('file', path=...) for each finished
+              file and emit('progress', stage=..., ...) while downloading
+        wait_for_transcode: Optional callback that blocks until an MP3 conversion may start
+        keep_source: Keep each downloaded stream next to its converted file and report it
+                     in the 'file' event, so other qualities can be made without downloading
+        info: Video info from probe_media(), used instead of extracting it again
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    url = clean_url(url)
+    ydl_opts = build_ydl_opts(template or build_ydl_template(), output_path, quality, threads)
+    if emit:
+        add_event_hooks(ydl_opts, quality, emit, wait_for_transcode)
+        if keep_source:
+            ydl_opts['keepvideo'] = True
+
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            if emit:
+                file_ready = FileReadyPP(emit, keep_source=keep_source)
+                ydl.add_post_processor(file_ready, when='after_move')
+                ydl.add_progress_hook(file_ready.record_source)
             print(f"Processing: {url}\n")
+            if info:
+                try:
+                    ydl.process_ie_result(info, download=True)
+                    print(f"\nDownload complete!")
+                    return True
+                except Exception as e:
+                    # E.g. the stream URLs in the info expired
+                    print(f"Saved video info failed ({e}), extracting again\n")
             # Just download directly - yt-dlp will handle playlists automatically
             ydl.download([url])
             print(f"\nDownload complete!")
@@ -128,21 +429,223 @@ def download_mp3(url, output_path='downloads', quality='320'):
         print(f"Error downloading: {e}")
         return False
 
+def derive_audio(source, info, output_path='downloads', quality='320', threads=None, template=None, emit=None,
+                 wait_for_transcode=None):
+    """
+    Convert a kept source stream to another quality, without downloading anything.
+
+    info is the dict saved with the source (title, artist, ...), used to name and
+    tag the output like a fresh download. Returns False if the source is gone or
+    the conversion failed.
+    """
+    if not source or not os.path.exists(source):
+        return False
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    ydl_opts = build_ydl_opts(template or build_ydl_template(), output_path, quality, threads)
+    if emit:
+        add_event_hooks(ydl_opts, quality, emit, wait_for_transcode)
+
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            if emit:
+                ydl.add_post_processor(FileReadyPP(emit, derived=True), when='after_move')
+            info = dict(info, ext=os.path.splitext(source)[1].lstrip('.'))
+            path = ydl.prepare_filename(info)
+            # Convert a copy; the cached source stays for other qualities
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copy2(source, path)
+            print(f"Converting cached source: {os.path.basename(path)}\n")
+            ydl.post_process(path, info)
+            print(f"\nDownload complete!")
+            return True
+    except Exception as e:
+        print(f"Error converting cached source: {e}")
+        return False
+
+# Info fields probe_media() drops: large, and not needed to download or tag audio
+PROBE_DROP_FIELDS = ('automatic_captions', 'subtitles', 'requested_subtitles', 'heatmap')
+
+def probe_media(url, template=None):
+    """
+    Extract a single video's info without downloading anything.
+
+    Raises yt-dlp's error for private, removed or geo-blocked videos. The result
+    is JSON-safe and can be passed back to download_mp3(info=...) while its
+    stream URLs are still valid.
+    """
+    ydl_opts = dict(template or build_ydl_template())
+    ydl_opts.update({'ignoreerrors': False, 'noplaylist': True})
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(clean_url(url), download=False))
+    for field in PROBE_DROP_FIELDS:
+        info.pop(field, None)
+    # Only audio is downloaded, video-only formats just take up space
+    info['formats'] = [fmt for fmt in info.get('formats') or [] if fmt.get('acodec') != 'none']
+    return info
+
+def list_playlist(url, template=None):
+    """
+    List a playlist's videos without downloading anything (flat extraction).
+
+    Returns (playlist title, entries), where each entry has the video's id, url and title.
+    """
+    ydl_opts = dict(template or build_ydl_template())
+    ydl_opts['extract_flat'] = 'in_playlist'
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(clean_url(url), download=False)
+    if not info:
+        return None, []
+
+    entries = []
+    for entry in info.get('entries') or []:
+        if not entry or not entry.get('id'):
+            continue
+        entries.append({
+            'id': entry['id'],
+            'url': f"https://www.youtube.com/watch?v={entry['id']}",
+            'title': entry.get('title'),
+        })
+    return info.get('title'), entries
+
+class EventLog(io.TextIOBase):
+    """Text stream that turns everything written to it into 'log' events"""
+    def __init__(self, emit):
+        self.emit = emit
+        self.buffer_text = ''
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.buffer_text += text
+        *lines, self.buffer_text = re.split(r'[\r\n]', self.buffer_text)
+        for line in lines:
+            if line.strip():
+                self.emit('log', line=line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+def serve(nice=0):
+    """
+    Run as a long-lived worker for the web app.
+
+    Reads one JSON job per line from stdin and reports everything back as JSON
+    events on stdout ({"event": "log"|"done"|..., ...}), so the web app can reuse
+    this process (with yt-dlp already imported and warmed up) for many downloads.
+    Each finished file is reported as a 'file' event with its absolute path and
+    download/conversion progress as 'progress' events. Jobs with "op": "expand"
+    only list a playlist and report its videos as an 'entries' event; jobs with
+    "op": "info" report a video's info (or the error) as an 'info' event; jobs with
+    "op": "derive" convert a kept source stream instead of downloading.
+
+    Before each MP3 conversion a 'transcode' event with state 'request' is sent
+    and the process waits for the web app to write a line back granting a
+    transcode slot, so the app can cap conversions across all processes.
+    """
+    events = sys.stdout
+    events_lock = threading.Lock()
+
+    # Downloads and conversions (including spotdl/ffmpeg children) run at a lower
+    # priority than the web app
+    if nice and hasattr(os, 'nice'):
+        os.nice(nice)
+
+    def emit(event, **fields):
+        fields['event'] = event
+        with events_lock:
+            events.write(json.dumps(fields) + '\n')
+            events.flush()
+
+    # Everything printed from here on (including yt-dlp output) becomes log events
+    sys.stdout = sys.stderr = EventLog(emit)
+
+    # Build the options template and load the extractors once, up front
+    template = build_ydl_template()
+    with yt_dlp.YoutubeDL(build_ydl_opts(template)) as ydl:
+        ydl.get_info_extractor('Youtube')
+    emit('ready', pid=os.getpid())
+
+    def wait_for_transcode(count=1):
+        """Ask the web app for count transcode slots and block until they are granted"""
+        emit('transcode', state='request', count=count)
+        sys.stdin.readline()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        ok = False
+        try:
+            job = json.loads(line)
+            url = job['url']
+            output_path = job.get('output', 'downloads')
+            quality = job.get('quality', '320')
+            threads = job.get('threads')
+            spotify_threads = job.get('spotify_threads')
+            keep_source = job.get('keep_source', False)
+
+            if job.get('op') == 'expand':
+                title, entries = list_playlist(url, template)
+                emit('entries', title=title, entries=entries)
+                ok = bool(entries)
+            elif job.get('op') == 'info':
+                try:
+                    emit('info', info=probe_media(url, template))
+                    ok = True
+                except Exception as e:
+                    emit('info', error=str(e))
+            elif is_spotify_url(url):
+                ok = download_spotify(url, output_path, quality, threads, emit, spotify_threads, wait_for_transcode)
+            else:
+                if job.get('op') == 'derive':
+                    ok = derive_audio(job.get('source'), job.get('info') or {}, output_path, quality,
+                                      threads, template, emit, wait_for_transcode)
+                    if not ok:
+                        print("Cached source unavailable, downloading instead\n")
+                if not ok:
+                    ok = download_mp3(url, output_path, quality, threads, template, emit,
+                                      wait_for_transcode, keep_source, job.get('preflight'))
+        except Exception as e:
+            print(f"Error: {e}")
+        emit('done', ok=bool(ok))
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description='Download audio from YouTube or Spotify')
-    parser.add_argument('url', help='URL to download')
-    parser.add_argument('--quality', default='320', choices=['128', '192', '256', '320'],
-                       help='Audio quality in kbps (default: 320)')
+    parser.add_argument('url', nargs='?', help='URL to download')
+    parser.add_argument('--quality', default='320', choices=['128', '192', '256', '320', PASSTHROUGH_QUALITY],
+                       help="Audio quality in kbps, or 'original' to keep the source audio (default: 320)")
+    parser.add_argument('--threads', type=int, default=None,
+                       help='Max threads for ffmpeg conversion (default: ffmpeg decides)')
+    parser.add_argument('--spotify-threads', type=int, default=None,
+                       help='Spotify tracks downloaded at once (default: spotdl decides)')
+    parser.add_argument('--serve', action='store_true',
+                       help='Run as a worker that reads JSON jobs from stdin (used by the web app)')
+    parser.add_argument('--nice', type=int, default=0,
+                       help='Lower the worker\'s CPU priority by this much (with --serve)')
 
     args = parser.parse_args()
 
+    if args.serve:
+        serve(args.nice)
+        sys.exit(0)
+
+    if not args.url:
+        parser.error('url is required')
+
     url = args.url
     quality = args.quality
 
     # Route to appropriate downloader based on URL
     if is_spotify_url(url):
-        download_spotify(url, quality=quality)
+        download_spotify(url, quality=quality, threads=args.threads, spotify_threads=args.spotify_threads)
     else:
-        download_mp3(url, quality=quality)
+        download_mp3(url, quality=quality, threads=args.threads)
@@ -1,5 +1,7 @@
 let activeDownloads = new Map();
 let pollInterval = null;
+let eventSource = null;
+let streamedTaskIds = '';
 
 function showError(message) {
     const errorDiv = document.getElementById('errorMessage');
@@ -77,13 +79,14 @@ async function startDownload() {
             // Add to active downloads
             activeDownloads.set(data.task_id, {
                 url: url,
-                status: 'queued'
+                status: 'queued',
+                // Title, duration and thumbnail from the server's preflight lookup
+                title: data.media ? data.media.title : '',
+                media: data.media
             });
 
-            // Start polling if not already running
-            if (!pollInterval) {
-                startPolling();
-            }
+            // Start receiving status updates
+            startUpdates();
 
             // Update UI immediately
             updateDownloadsUI();
@@ -101,6 +104,152 @@ async function startDownload() {
     }
 }
 
+function isFinished(status) {
+    return status === 'completed' || status === 'failed' || status === 'cancelled';
+}
+
+// Apply a full status object for a task (from polling or a merged stream update)
+function applyStatus(taskId, download, data) {
+    // Check if download just completed
+    const wasCompleted = download.status === 'completed';
+    const isNowCompleted = data.status === 'completed' && !wasCompleted;
+
+    data.removeTimeout = download.removeTimeout;
+    activeDownloads.set(taskId, data);
+
+    // Auto-download files as they become available
+    // Check for new files that haven't been downloaded yet
+    if (data.files && data.files.length > 0) {
+        const previousFiles = new Set(download.files || []);
+        const newFiles = data.files.filter(file => !previousFiles.has(file));
+
+        if (newFiles.length > 0) {
+            console.log('New files available:', newFiles);
+
+            // Download new files immediately
+            newFiles.forEach((file, index) => {
+                setTimeout(() => {
+                    console.log('Triggering download for:', file);
+                    const filename = fileDisplayName(file);
+                    showNotification(`Downloading: ${filename}`, 'success');
+                    downloadFile(file);
+                }, index * 500); // 500ms delay between each
+            });
+        }
+    }
+
+    // Show final completion notification
+    if (isNowCompleted) {
+        const fileCount = data.files.length;
+        const message = fileCount === 1
+            ? 'Download complete!'
+            : `All ${fileCount} files downloaded!`;
+        showNotification(message, 'success');
+    }
+
+    // Remove completed or failed downloads after 2 minutes
+    if ((data.status === 'completed' || data.status === 'failed') &&
+        !data.removeTimeout) {
+        data.removeTimeout = setTimeout(() => {
+            // Fade out animation
+            const card = document.getElementById(`download-${taskId}`);
+            if (card) {
+                card.style.opacity = '0';
+                card.style.transform = 'translateY(-10px)';
+                setTimeout(() => {
+                    activeDownloads.delete(taskId);
+                    updateDownloadsUI();
+                }, 300);
+            } else {
+                activeDownloads.delete(taskId);
+                updateDownloadsUI();
+            }
+        }, 120000); // 2 minutes
+    }
+}
+
+// Receive status updates over Server-Sent Events, falling back to polling
+// (also when the server refuses the stream with a 503 because it is busy)
+function startUpdates() {
+    if (pollInterval) {
+        return; // Polling already covers every download
+    }
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const taskIds = [...activeDownloads.entries()]
+        .filter(([, download]) => !isFinished(download.status))
+        .map(([taskId]) => taskId);
+    const key = taskIds.join(',');
+
+    if (eventSource && key === streamedTaskIds) {
+        return;
+    }
+    closeStream();
+    if (taskIds.length === 0) {
+        return;
+    }
+
+    streamedTaskIds = key;
+    eventSource = new EventSource(`/apps/music-downloader/api/events?tasks=${encodeURIComponent(key)}`);
+
+    eventSource.addEventListener('update', (event) => {
+        const delta = JSON.parse(event.data);
+        const download = activeDownloads.get(delta.task_id);
+        if (!download) {
+            return;
+        }
+
+        // Merge the changed fields into the last known status; the first update of
+        // each connection is a snapshot that replaces the files and logs
+        const data = Object.assign({}, download, delta);
+        const known = delta.snapshot ? {} : download;
+        data.files = (known.files || []).concat(delta.new_files || []);
+        data.logs = (known.logs || []).concat(delta.new_logs || []).slice(-50);
+        delete data.new_files;
+        delete data.new_logs;
+        delete data.snapshot;
+
+        applyStatus(delta.task_id, download, data);
+        updateDownloadsUI();
+    });
+
+    eventSource.addEventListener('gone', (event) => {
+        const data = JSON.parse(event.data);
+        console.log(`Task ${data.task_id} not found on server, removing from UI`);
+        activeDownloads.delete(data.task_id);
+        updateDownloadsUI();
+    });
+
+    eventSource.addEventListener('stats', (event) => {
+        showStats(JSON.parse(event.data));
+    });
+
+    eventSource.addEventListener('end', () => {
+        closeStream();
+    });
+
+    eventSource.onerror = () => {
+        // The browser reconnects by itself unless the stream was refused
+        if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+            closeStream();
+            if (!pollInterval) {
+                startPolling();
+            }
+        }
+    };
+}
+
+function closeStream() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+    streamedTaskIds = '';
+}
+
 function startPolling() {
     pollInterval = setInterval(async () => {
         if (activeDownloads.size === 0) {
@@ -114,62 +263,7 @@ function startPolling() {
                 const response = await fetch(`/apps/music-downloader/api/status/${taskId}`);
                 if (response.ok) {
                     const data = await response.json();
-
-                    // Check if download just completed
-                    const wasCompleted = download.status === 'completed';
-                    const isNowCompleted = data.status === 'completed' && !wasCompleted;
-
-                    activeDownloads.set(taskId, data);
-
-                    // Auto-download files as they become available
-                    // Check for new files that haven't been downloaded yet
-                    if (data.files && data.files.length > 0) {
-                        const previousFiles = new Set(download.files || []);
-                        const newFiles = data.files.filter(file => !previousFiles.has(file));
-
-                        if (newFiles.length > 0) {
-                            console.log('New files available:', newFiles);
-
-                            // Download new files immediately
-                            newFiles.forEach((file, index) => {
-                                setTimeout(() => {
-                                    console.log('Triggering download for:', file);
-                                    const filename = file.split('/').pop();
-                                    showNotification(`Downloading: ${filename}`, 'success');
-                                    downloadFile(file);
-                                }, index * 500); // 500ms delay between each
-                            });
-                        }
-                    }
-
-                    // Show final completion notification
-                    if (isNowCompleted) {
-                        const fileCount = data.files.length;
-                        const message = fileCount === 1
-                            ? 'Download complete!'
-                            : `All ${fileCount} files downloaded!`;
-                        showNotification(message, 'success');
-                    }
-
-                    // Remove completed or failed downloads after 2 minutes
-                    if ((data.status === 'completed' || data.status === 'failed') &&
-                        !download.removeTimeout) {
-                        download.removeTimeout = setTimeout(() => {
-                            // Fade out animation
-                            const card = document.getElementById(`download-${taskId}`);
-                            if (card) {
-                                card.style.opacity = '0';
-                                card.style.transform = 'translateY(-10px)';
-                                setTimeout(() => {
-                                    activeDownloads.delete(taskId);
-                                    updateDownloadsUI();
-                                }, 300);
-                            } else {
-                                activeDownloads.delete(taskId);
-                                updateDownloadsUI();
-                            }
-                        }, 120000); // 2 minutes
-                    }
+                    applyStatus(taskId, download, data);
                 } else if (response.status === 404) {
                     // Task not found on server, remove from activeDownloads
                     console.log(`Task ${taskId} not found on server, removing from UI`);
@@ -213,6 +307,11 @@ function updateDownloadsUI() {
                 progressFill.style.width = `${download.progress || 0}%`;
             }
 
+            const progressInfo = card.querySelector('.progress-info');
+            if (progressInfo) {
+                progressInfo.textContent = formatProgressInfo(download);
+            }
+
             // Update title if available
             const titleElement = card.querySelector('.download-title');
             const urlSmallElement = card.querySelector('.download-url-small');
@@ -249,10 +348,11 @@ function updateDownloadsUI() {
                     const filesHTML = `
                         <div class="download-files">
                             <h4>Downloaded (${download.files.length} file${download.files.length > 1 ? 's' : ''}):</h4>
+                            ${archiveLinkHTML(taskId, download)}
                             <div class="file-list">
                                 ${download.files.map(file => `
                                     <div class="file-item">
-                                        <span class="file-name" title="${file}">✅ ${file}</span>
+                                        <span class="file-name" title="${escapeHtml(fileDisplayName(file))}">✅ ${escapeHtml(fileDisplayName(file))}</span>
                                     </div>
                                 `).join('')}
                             </div>
@@ -304,10 +404,11 @@ function createDownloadCard(taskId, download) {
         filesHTML = `
             <div class="download-files">
                 <h4>Downloaded (${download.files.length} file${download.files.length > 1 ? 's' : ''}):</h4>
+                ${archiveLinkHTML(taskId, download)}
                 <div class="file-list">
                     ${download.files.map(file => `
                         <div class="file-item">
-                            <span class="file-name" title="${file}">✅ ${file}</span>
+                            <span class="file-name" title="${escapeHtml(fileDisplayName(file))}">✅ ${escapeHtml(fileDisplayName(file))}</span>
                         </div>
                     `).join('')}
                 </div>
@@ -339,13 +440,21 @@ function createDownloadCard(taskId, download) {
         <button class="cancel-btn" onclick="cancelDownload('${taskId}')">Cancel</button>
     ` : '';
 
+    const media = download.media;
+    const thumbnailHTML = media && media.thumbnail
+        ? `<img class="download-thumbnail" src="${escapeHtml(media.thumbnail)}" alt="" loading="lazy">`
+        : '';
+    const mediaDetails = media ? [media.uploader, formatDuration(media.duration)].filter(Boolean).join(' · ') : '';
+
     card.innerHTML = `
         <div class="download-header">
+            ${thumbnailHTML}
             <div class="download-title-section">
                 <div class="download-title" title="${escapeHtml(displayTitle)}">
                     ${escapeHtml(displayTitle)} ${playlistInfo}
                 </div>
                 ${isUrl ? '' : `<div class="download-url-small" title="${escapeHtml(download.url)}">${escapeHtml(download.url)}</div>`}
+                ${mediaDetails ? `<div class="download-media-details">${escapeHtml(mediaDetails)}</div>` : ''}
             </div>
             <div class="download-actions">
                 ${cancelButtonHTML}
@@ -356,6 +465,7 @@ function createDownloadCard(taskId, download) {
             <div class="progress-bar">
                 <div class="progress-fill" style="width: ${download.progress || 0}%"></div>
             </div>
+            <div class="progress-info">${escapeHtml(formatProgressInfo(download))}</div>
         ` : ''}
         ${errorHTML}
         ${filesHTML}
@@ -405,6 +515,55 @@ function downloadFile(filename) {
     console.log('Download triggered for:', filename);
 }
 
+const STAGE_LABELS = {
+    fetch: 'Downloading',
+    transcode: 'Converting',
+    tag: 'Tagging'
+};
+
+// Describe the current stage, speed and ETA, e.g. "Downloading · 1.2 MB/s · 5s left"
+function formatProgressInfo(download) {
+    if (download.status !== 'downloading' || !download.stage) {
+        return '';
+    }
+    const parts = [STAGE_LABELS[download.stage] || download.stage];
+    if (download.playlist_count > 1) {
+        parts.push(`${download.playlist_current}/${download.playlist_count}`);
+    }
+    if (download.stage === 'fetch' && download.speed) {
+        parts.push(`${(download.speed / 1048576).toFixed(1)} MB/s`);
+    }
+    if (download.stage === 'fetch' && download.eta != null) {
+        parts.push(`${download.eta}s left`);
+    }
+    return parts.join(' · ');
+}
+
+// Seconds as m:ss or h:mm:ss
+function formatDuration(seconds) {
+    if (!seconds) {
+        return '';
+    }
+    seconds = Math.round(seconds);
+    const hours = Math.floor(seconds / 3600);
+    const minutes = Math.floor((seconds % 3600) / 60);
+    const rest = String(seconds % 60).padStart(2, '0');
+    return hours ? `${hours}:${String(minutes).padStart(2, '0')}:${rest}` : `${minutes}:${rest}`;
+}
+
+// Playlists can be saved as one ZIP instead of file by file
+function archiveLinkHTML(taskId, download) {
+    if (download.playlist_count <= 1 && download.files.length <= 1) {
+        return '';
+    }
+    return `<a class="archive-link" href="/apps/music-downloader/download-archive/${taskId}">Download all as ZIP</a>`;
+}
+
+// Files are published as "<task_id>/<name>.mp3", only show the name
+function fileDisplayName(file) {
+    return file.split(/[/\\]/).pop();
+}
+
 function escapeHtml(text) {
     const div = document.createElement('div');
     div.textContent = text;
@@ -425,10 +584,10 @@ async function loadExistingDownloads() {
                 }
             });
 
-            // Start polling if there are active downloads
+            // Start receiving updates if there are active downloads
             if (activeDownloads.size > 0) {
                 updateDownloadsUI();
-                startPolling();
+                startUpdates();
             }
         }
     } catch (error) {
@@ -450,20 +609,27 @@ function formatNumber(num) {
     return num.toString();
 }
 
+function showStats(stats) {
+    const totalElement = document.getElementById('totalDownloads');
+    const actualElement = document.getElementById('totalDownloadsActual');
+    if (totalElement) {
+        totalElement.textContent = formatNumber(stats.total_downloads);
+    }
+    if (actualElement) {
+        actualElement.textContent = '(' + stats.total_downloads.toLocaleString() + ')';
+    }
+}
+
 // Poll for stats updates
 async function updateStats() {
+    // An open status stream already pushes stats changes
+    if (eventSource) {
+        return;
+    }
     try {
         const response = await fetch('/apps/music-downloader/api/stats');
         if (response.ok) {
-            const stats = await response.json();
-            const totalElement = document.getElementById('totalDownloads');
-            const actualElement = document.getElementById('totalDownloadsActual');
-            if (totalElement) {
-                totalElement.textContent = formatNumber(stats.total_downloads);
-            }
-            if (actualElement) {
-                actualElement.textContent = '(' + stats.total_downloads.toLocaleString() + ')';
-            }
+            showStats(await response.json());
         }
     } catch (error) {
         console.error('Stats update error:', error);
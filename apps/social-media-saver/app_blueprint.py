@@ -1,9 +1,21 @@
-from flask import Blueprint, render_template, request, jsonify, send_file
+from flask import Blueprint, Response, render_template, request, jsonify
 import os
+import mimetypes
 import threading
 import time
 import uuid
-from datetime import datetime, timedelta
+import shutil
+import json
+import atexit
+import socket
+import importlib.util
+import zipfile
+from collections import deque
+from itertools import islice
+from shared.metrics import Counter, Histogram, STAGE_BUCKETS
+from shared.files import ExpiryScheduler, ZipStream, ARCHIVE_CHUNK_SIZE, X_ACCEL_REDIRECT, serve_held, count_served
+from shared.state import DATA_DIR, MemoryStore, SQLiteStore
+from shared.responses import long_responses, busy_response
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -13,11 +25,272 @@ social_media_bp = Blueprint('social_media_saver', __name__,
                             static_url_path='/static')
 
 DOWNLOAD_FOLDER = os.path.join(APP_DIR, 'downloads')
+TEMP_FOLDER = os.path.join(APP_DIR, 'temp_downloads')  # Per-download staging folders
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+os.makedirs(TEMP_FOLDER, exist_ok=True)
+
+# Loaded once so its pool of yt-dlp instances is shared by every download
+downloader_spec = importlib.util.spec_from_file_location('social_downloader', os.path.join(APP_DIR, 'downloader.py'))
+downloader_module = importlib.util.module_from_spec(downloader_spec)
+downloader_spec.loader.exec_module(downloader_module)
+
+FILE_TTL = 30  # Seconds a finished file is kept
+LOG_LINES = 50  # Log lines kept per download
+
+# Download workers: a fixed pool takes downloads from a FIFO queue
+WORKER_COUNT = int(os.environ.get('SOCIAL_WORKERS', '4'))
+PLATFORM_LIMITS = {  # Downloads of one platform running at once
+    'instagram': int(os.environ.get('SOCIAL_INSTAGRAM_SLOTS', '2')),
+    'tiktok': int(os.environ.get('SOCIAL_TIKTOK_SLOTS', '2')),
+    'twitter': int(os.environ.get('SOCIAL_TWITTER_SLOTS', '2')),
+    'facebook': int(os.environ.get('SOCIAL_FACEBOOK_SLOTS', '2')),
+}
+SHUTDOWN_TIMEOUT = 10  # Seconds running downloads get to finish when the process exits
+
+# Batches: several links submitted together and saved as one streamed ZIP
+BATCH_MAX_URLS = int(os.environ.get('SOCIAL_BATCH_MAX', '20'))
+ARCHIVE_POLL_INTERVAL = 0.5  # Seconds between checks for newly finished downloads of an archive
+ARCHIVE_MAX_DURATION = int(os.environ.get('SOCIAL_ARCHIVE_MAX_DURATION', '900'))  # Seconds before an archive stops adding files
+
+# Streaming: single-file posts are piped from the origin to the client without touching the disk
+STREAM_SLOTS = int(os.environ.get('SOCIAL_STREAM_SLOTS', '8'))  # Streams at once; more become normal downloads
+STREAM_TOKEN_TTL = 120  # Seconds a resolved stream can be started (or, when teed, fetched again)
+STREAM_TEE = os.environ.get('SOCIAL_STREAM_TEE', '0') == '1'  # Also save streamed files, so retries are served from disk
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Admission control: new downloads are refused (429/503) past these limits
+MAX_ACTIVE = int(os.environ.get('SOCIAL_MAX_ACTIVE', '20'))  # Downloads queued or running at once
+MIN_FREE_BYTES = int(os.environ.get('SOCIAL_MIN_FREE_MB', '1024')) * 1024 * 1024  # Free disk in DOWNLOAD_FOLDER
+
+# nginx location that serves DOWNLOAD_FOLDER when X_ACCEL_REDIRECT is on
+ACCEL_REDIRECT_PREFIX = '/_protected/social-media-saver/'
+
+# Saved download state, so queued and running downloads survive a restart.
+# 'memory' keeps state in this process only.
+STATE_BACKEND = os.environ.get('SOCIAL_STATE_BACKEND', 'sqlite')
+STATE_DB = os.environ.get('SOCIAL_STATE_DB', os.path.join(DATA_DIR, 'social_state.db'))
+STATE_SYNC_INTERVAL = 0.5  # Seconds between writes of changed downloads to the state store
+STATE_TTL = 3600  # Seconds finished downloads stay in the state store
+WORKER_HEARTBEAT = 5  # Seconds between liveness updates of this process
+WORKER_TIMEOUT = 30  # A previous process silent for this long is gone and its downloads are restarted
+
+FINISHED_STATUSES = ('completed', 'failed')
 
 # Store download status
+class LogBuffer(deque):
+    """
+    The last LOG_LINES log lines of a download. `total` counts every line ever
+    added and is the cursor clients pass as ?since= to get only newer lines.
+    """
+    def __init__(self, lines=(), total=None):
+        super().__init__(lines, maxlen=LOG_LINES)
+        self.total = len(self) if total is None else total
+
+    def append(self, line):
+        super().append(line)
+        self.total += 1
+
+def logs_since(logs, total, cursor):
+    """Lines of `logs` (the newest, ending at line number `total`) added after `cursor`"""
+    count = min(max(total - cursor, 0), len(logs))
+    return list(islice(logs, len(logs) - count, None))
+
 downloads = {}
-total_downloads = 0  # Global stats counter
+batches = {}  # batch_id -> download ids, in submission order
+streams = {}  # stream token -> resolved media, platform and (when teed) the saved file
+active_streams = 0
+stream_lock = threading.Lock()
+total_downloads = 0  # Downloads finished by this process; the saved total is in state_store
+download_times = deque(maxlen=50)  # Recent download durations in seconds, for Retry-After
+
+archived_downloads = {}  # download_id -> number of archive streams that still have to send its files
+archived_lock = threading.Lock()
+
+def archive_holds(path):
+    """Whether a file ("<download_id>.<ext>" or "<download_id>_<n>.<ext>") is still wanted by an archive"""
+    download_id = os.path.basename(path).split('.')[0].split('_')[0]
+    with archived_lock:
+        return download_id in archived_downloads
+
+file_expiry = ExpiryScheduler(DOWNLOAD_FOLDER, FILE_TTL, is_busy=archive_holds)
+
+class DownloadQueue:
+    """
+    FIFO queue that hands out the oldest download whose platform has a free slot,
+    so a burst of links for one platform can't take every worker.
+    """
+    def __init__(self, platform_limits):
+        self.platform_limits = dict(platform_limits)
+        self.running = {platform: 0 for platform in platform_limits}
+        self.pending = deque()  # (download_id, url, platform, queued_at)
+        self.busy_workers = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, download_id, url, platform):
+        with self.condition:
+            self.pending.append((download_id, url, platform, time.time()))
+            self.condition.notify_all()
+
+    def get(self):
+        """Block until a download can run without exceeding its platform's limit; None once closed"""
+        with self.condition:
+            while not self.closed:
+                for job in self.pending:
+                    platform = job[2]
+                    if self.running.get(platform, 0) >= self.platform_limits.get(platform, 1):
+                        continue
+                    self.pending.remove(job)
+                    self.running[platform] = self.running.get(platform, 0) + 1
+                    self.busy_workers += 1
+                    stage_seconds.observe(time.time() - job[3], stage='queued')
+                    return job
+                self.condition.wait()
+            return None
+
+    def task_done(self, platform):
+        with self.condition:
+            self.running[platform] -= 1
+            self.busy_workers -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        """Stop handing out downloads; workers exit once their current one is done"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def qsize(self):
+        return len(self.pending)
+
+    def active(self):
+        """Downloads queued or running"""
+        with self.condition:
+            return len(self.pending) + self.busy_workers
+
+    def position(self, download_id):
+        """1-based position among queued downloads, or 0 if not queued"""
+        with self.condition:
+            for index, job in enumerate(self.pending):
+                if job[0] == download_id:
+                    return index + 1
+        return 0
+
+# Metrics, rendered in Prometheus text format by /metrics in main.py
+stage_seconds = Histogram(STAGE_BUCKETS)  # queued, extract, fetch, publish, serve
+fetched_bytes = Counter()
+served_bytes = Counter()
+download_outcomes = Counter()  # Finished downloads by platform and status
+
+download_queue = DownloadQueue(PLATFORM_LIMITS)
+
+class MemoryStateBackend(MemoryStore):
+    """State kept only in this process (the downloads dict)"""
+    def save_downloads(self, worker_id, records):
+        pass
+
+    def claim_orphans(self, worker_id, timeout):
+        return []
+
+    def unfinished_download_ids(self):
+        return set()
+
+    def evict(self, ttl):
+        pass
+
+class SQLiteStateBackend(SQLiteStore):
+    """
+    Download status and the process running each download in the database.
+    Unfinished downloads of a process that stopped are restarted by the next one.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS downloads (
+            download_id TEXT PRIMARY KEY,
+            owner TEXT,
+            status TEXT NOT NULL,
+            record TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS downloads_status ON downloads (status, owner);
+    """
+
+    def save_downloads(self, worker_id, records):
+        """Insert or update (download_id, record) pairs owned by a worker, in one transaction"""
+        now = time.time()
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'INSERT OR REPLACE INTO downloads (download_id, owner, status, record, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [(download_id, worker_id, record['status'], json.dumps(record), now)
+                 for download_id, record in records])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def claim_orphans(self, worker_id, timeout):
+        """Take over unfinished downloads of processes that stopped sending heartbeats"""
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            deadline = time.time() - timeout
+            rows = db.execute(
+                'SELECT download_id, record FROM downloads WHERE status IN (?, ?) AND (owner IS NULL OR owner NOT IN '
+                '(SELECT worker_id FROM workers WHERE heartbeat >= ?))',
+                ('queued', 'downloading', deadline)).fetchall()
+            db.executemany('UPDATE downloads SET owner = ? WHERE download_id = ?',
+                           [(worker_id, row[0]) for row in rows])
+            db.execute('DELETE FROM workers WHERE heartbeat < ?', (deadline,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return [(download_id, json.loads(record)) for download_id, record in rows]
+
+    def unfinished_download_ids(self):
+        """Downloads still queued or downloading, whichever process ran them"""
+        rows = self._connect().execute('SELECT download_id FROM downloads WHERE status IN (?, ?)',
+                                       ('queued', 'downloading')).fetchall()
+        return {row[0] for row in rows}
+
+    def evict(self, ttl):
+        """Forget finished downloads older than ttl seconds"""
+        self._connect().execute('DELETE FROM downloads WHERE status IN (?, ?) AND updated_at < ?',
+                                FINISHED_STATUSES + (time.time() - ttl,))
+
+def open_state_backend():
+    """The configured state backend, falling back to process memory if the database can't be opened"""
+    if STATE_BACKEND == 'sqlite':
+        try:
+            return SQLiteStateBackend(STATE_DB)
+        except Exception as e:
+            print(f"State database error, keeping state in memory: {e}")
+    return MemoryStateBackend()
+
+state_store = open_state_backend()
+worker_id = None  # This process in the state store, set by start_background()
+synced_total = 0  # Part of total_downloads already added to the state store
+
+def find_stream(token):
+    """A resolved stream, else None; tokens expire after STREAM_TOKEN_TTL"""
+    record = streams.get(token)
+    if record is None or time.time() - record['created_at'] > STREAM_TOKEN_TTL:
+        return None
+    return record
+
+def download_files(info):
+    """Published file names of a download; several for carousels"""
+    return info.get('files') or ([info['file']] if info.get('file') else [])
+
+def download_record(download_id, info):
+    """A copy of a download's status that later updates don't change, with its queue position"""
+    position = download_queue.position(download_id) if info['status'] == 'queued' else 0
+    return dict(info, logs=list(info['logs']), log_cursor=info['logs'].total, queue_position=position)
+
+def total_download_count():
+    """Downloads finished since the first start, including ones this process hasn't synced yet"""
+    return state_store.total() + total_downloads - synced_total
 
 @social_media_bp.route('/')
 def index():
@@ -38,6 +311,209 @@ def download():
     if not platform:
         return jsonify({'error': 'Unsupported platform. Please use Instagram, TikTok, Twitter/X, or Facebook URLs.'}), 400
 
+    if download_queue.closed:
+        return jsonify({'error': 'The server is restarting, please try again in a moment'}), 503
+
+    rejection = check_admission()
+    if rejection:
+        return rejection
+
+    download_id = queue_download(url, platform)
+
+    return jsonify({
+        'download_id': download_id,
+        'platform': platform,
+        'queue_position': download_queue.position(download_id)
+    })
+
+@social_media_bp.route('/api/stream', methods=['POST'])
+def start_stream():
+    """
+    Resolve a post for streaming. Single-file posts get a token for
+    /api/stream/<token>, which pipes the origin's bytes to the client. Anything
+    else (carousels, fragmented formats, no free stream slot, lookup errors) is
+    queued as a normal download and answered like /api/download.
+    """
+    data = request.get_json(silent=True) or {}
+    url = data.get('url', '').strip()
+
+    if not url:
+        return jsonify({'error': 'Please provide a valid URL'}), 400
+
+    platform = detect_platform(url)
+    if not platform:
+        return jsonify({'error': 'Unsupported platform. Please use Instagram, TikTok, Twitter/X, or Facebook URLs.'}), 400
+
+    # Streams are admitted like downloads, before any lookup is made
+    if download_queue.closed:
+        return jsonify({'error': 'The server is restarting, please try again in a moment'}), 503
+
+    rejection = check_admission()
+    if rejection:
+        return rejection
+
+    media = None
+    if active_streams < STREAM_SLOTS and long_responses.available():
+        resolve_started = time.time()
+        try:
+            media = downloader_module.resolve_stream(url, platform)
+        except Exception as e:
+            print(f"Stream lookup failed, using a normal download: {e}")
+        stage_seconds.observe(time.time() - resolve_started, stage='extract')
+
+    if media is None:
+        download_id = queue_download(url, platform)
+        return jsonify({
+            'mode': 'download',
+            'download_id': download_id,
+            'platform': platform,
+            'queue_position': download_queue.position(download_id)
+        })
+
+    # Forget expired tokens of this process, except streams still being sent
+    now = time.time()
+    for expired in [token for token, record in list(streams.items())
+                    if now - record['created_at'] > STREAM_TOKEN_TTL and record.get('status') != 'streaming']:
+        streams.pop(expired, None)
+
+    token = str(uuid.uuid4())
+    streams[token] = dict(media, platform=platform, source_url=url, created_at=time.time(), file=None)
+
+    return jsonify({
+        'mode': 'stream',
+        'stream_token': token,
+        'platform': platform,
+        'filesize': media['filesize']
+    })
+
+@social_media_bp.route('/api/stream/<token>', methods=['GET', 'HEAD'])
+def stream_file(token):
+    """
+    Pipe a resolved post from the origin to the client, or send its teed copy if
+    one was saved. HEAD only checks the token and that a stream slot is free,
+    without contacting the origin.
+    """
+    global active_streams
+    record = find_stream(token)
+    if record is None:
+        return jsonify({'error': 'Stream not found or expired'}), 404
+
+    filename = f"{token}.{record['ext']}"
+    if record['file']:
+        file_path = os.path.join(DOWNLOAD_FOLDER, record['file'])
+        if os.path.isfile(file_path):
+            return serve_held(file_expiry, file_path, DOWNLOAD_FOLDER, ACCEL_REDIRECT_PREFIX)
+
+    if request.method == 'HEAD':
+        if active_streams >= STREAM_SLOTS or not long_responses.available():
+            return busy_response()
+        return Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+
+    with stream_lock:
+        if active_streams >= STREAM_SLOTS:
+            response = jsonify({'error': 'Too many streams are running, please try again in a moment', 'retry_after': 5})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        active_streams += 1
+    if not long_responses.acquire():
+        with stream_lock:
+            active_streams -= 1
+        return busy_response()
+
+    try:
+        source = downloader_module.MediaStream(record, record['platform'])
+    except Exception as e:
+        with stream_lock:
+            active_streams -= 1
+        long_responses.release()
+        print(f"Stream error: {e}")
+        return jsonify({'error': f"Could not reach {record['platform']}, please try again"}), 502
+
+    headers = {
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no',
+    }
+    if source.headers.get('Content-Length'):
+        headers['Content-Length'] = source.headers['Content-Length']
+        record['filesize'] = record['filesize'] or int(source.headers['Content-Length'])
+    mimetype = mimetypes.guess_type(filename)[0] or source.headers.get('Content-Type') or 'application/octet-stream'
+    response = Response(pipe_stream(token, record, source), mimetype=mimetype, headers=headers)
+    response.call_on_close(lambda: end_stream(source))
+    return response
+
+@social_media_bp.route('/api/stream/<token>/status')
+def get_stream_status(token):
+    """How far a stream of this process has been sent: status is ready, streaming, completed or failed"""
+    record = streams.get(token)
+    if record is None:
+        return jsonify({'error': 'Stream not found or expired'}), 404
+    return jsonify({
+        'status': record.get('status', 'ready'),
+        'sent': record.get('sent', 0),
+        'filesize': record['filesize']
+    })
+
+def end_stream(source):
+    """Close a stream's origin response and free its slots"""
+    global active_streams
+    source.close()
+    with stream_lock:
+        active_streams -= 1
+    long_responses.release()
+
+def pipe_stream(token, record, source):
+    """
+    Generate a stream's bytes as they arrive from the origin. Progress is kept in
+    the record for /api/stream/<token>/status. With STREAM_TEE the bytes are also
+    written to a staging file that is published like a finished download once the
+    whole file has been sent.
+    """
+    global total_downloads
+    started = time.time()
+    sent = 0
+    complete = False
+    tee = None
+    if STREAM_TEE:
+        staging_folder = os.path.join(TEMP_FOLDER, token)
+        os.makedirs(staging_folder, exist_ok=True)
+        tee_path = os.path.join(staging_folder, f"{token}.{record['ext']}")
+        tee = open(tee_path, 'wb')
+    record['status'] = 'streaming'
+    record['sent'] = 0
+    try:
+        while True:
+            chunk = source.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            if tee:
+                tee.write(chunk)
+            sent += len(chunk)
+            record['sent'] = sent
+            yield chunk
+        complete = True
+    except Exception as e:
+        print(f"Stream error: {e}")
+    finally:
+        record['status'] = 'completed' if complete else 'failed'
+        platform = record['platform']
+        fetched_bytes.inc(sent, platform=platform)
+        served_bytes.inc(sent, kind='stream')
+        stage_seconds.observe(time.time() - started, stage='serve')
+        download_outcomes.inc(platform=platform, status='completed' if complete else 'failed')
+        if complete:
+            total_downloads += 1
+        if tee:
+            tee.close()
+            if complete:
+                published_path = os.path.join(DOWNLOAD_FOLDER, os.path.basename(tee_path))
+                os.replace(tee_path, published_path)
+                file_expiry.schedule(published_path)
+                record['file'] = os.path.basename(published_path)
+            shutil.rmtree(staging_folder, ignore_errors=True)
+
+def queue_download(url, platform):
+    """Create a download's status and put it on the worker queue; returns its id"""
     # Generate unique download ID
     download_id = str(uuid.uuid4())
 
@@ -48,48 +524,288 @@ def download():
         'url': url,
         'progress': 0,
         'file': None,
+        'files': [],
         'error': None,
-        'logs': []
+        'logs': LogBuffer()
     }
 
-    # Start download in background thread
-    thread = threading.Thread(target=process_download, args=(download_id, url, platform))
-    thread.daemon = True
-    thread.start()
+    download_queue.put(download_id, url, platform)
+    try:
+        state_store.save_downloads(worker_id, [(download_id, download_record(download_id, downloads[download_id]))])
+    except Exception as e:
+        print(f"State store error: {e}")
+    return download_id
+
+@social_media_bp.route('/api/batch', methods=['POST'])
+def download_batch():
+    """
+    Start downloads for several URLs at once. They run in parallel under the
+    usual worker and per-platform limits; unsupported URLs are reported in
+    'rejected' without failing the batch.
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls')
+
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'error': 'No URLs provided'}), 400
+
+    # Drop blanks and repeats, keeping the submitted order
+    urls = list(dict.fromkeys(url.strip() for url in urls if isinstance(url, str) and url.strip()))
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({'error': f'A batch can have at most {BATCH_MAX_URLS} URLs'}), 400
 
-    return jsonify({'download_id': download_id, 'platform': platform})
+    accepted = []
+    rejected = []
+    for url in urls:
+        platform = detect_platform(url)
+        if platform:
+            accepted.append((url, platform))
+        else:
+            rejected.append({'url': url, 'error': 'Unsupported platform. Please use Instagram, TikTok, Twitter/X, or Facebook URLs'})
+
+    if not accepted:
+        return jsonify({'error': 'None of the URLs are supported', 'rejected': rejected}), 400
+
+    if download_queue.closed:
+        return jsonify({'error': 'The server is restarting, please try again in a moment'}), 503
+
+    rejection = check_admission(len(accepted))
+    if rejection:
+        return rejection
+
+    batch_id = str(uuid.uuid4())
+    download_ids = [queue_download(url, platform) for url, platform in accepted]
+    batches[batch_id] = download_ids
+
+    return jsonify({
+        'batch_id': batch_id,
+        'downloads': [{
+            'download_id': download_id,
+            'url': url,
+            'platform': platform,
+            'queue_position': download_queue.position(download_id)
+        } for download_id, (url, platform) in zip(download_ids, accepted)],
+        'rejected': rejected
+    })
+
+@social_media_bp.route('/api/batch/<batch_id>')
+def get_batch_status(batch_id):
+    """Status of every download in a batch, without their logs"""
+    download_ids = batches.get(batch_id)
+    if download_ids is None:
+        return jsonify({'error': 'Batch not found'}), 404
+
+    statuses = []
+    for download_id in download_ids:
+        info = downloads.get(download_id)
+        if info is None:
+            statuses.append({'download_id': download_id, 'status': 'failed', 'error': 'Download not found'})
+            continue
+        statuses.append({
+            'download_id': download_id,
+            'url': info['url'],
+            'platform': info['platform'],
+            'status': info['status'],
+            'progress': info['progress'],
+            'files': download_files(info),
+            'error': info['error']
+        })
+
+    return jsonify({
+        'batch_id': batch_id,
+        'finished': all(status['status'] in FINISHED_STATUSES for status in statuses),
+        'downloads': statuses
+    })
+
+@social_media_bp.route('/api/batch/<batch_id>/archive')
+def download_batch_archive(batch_id):
+    """Stream a batch's files as one ZIP, starting before every download has finished"""
+    download_ids = batches.get(batch_id)
+    if download_ids is None:
+        return jsonify({'error': 'Batch not found'}), 404
+
+    return archive_response(download_ids, 'social-media-batch.zip')
+
+def archive_response(download_ids, filename):
+    """Stream downloads' files as one ZIP, or a 503 when too many long-lived responses are open"""
+    if not long_responses.acquire():
+        return busy_response()
+    response = Response(count_served(stream_archive(download_ids), served_bytes, stage_seconds), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(long_responses.release)
+    return response
+
+def check_admission(count=1):
+    """
+    Refuse new downloads when the server is saturated, so clients are told to
+    come back later instead of waiting into a proxy timeout.
+
+    Returns an error response (503 when the disk is nearly full, 429 when too
+    many downloads are running) with Retry-After, or None to accept `count`
+    new downloads.
+    """
+    try:
+        free_bytes = shutil.disk_usage(DOWNLOAD_FOLDER).free
+    except OSError:
+        free_bytes = MIN_FREE_BYTES
+    if free_bytes < MIN_FREE_BYTES:
+        # Space comes back as finished files expire
+        retry_after = max(FILE_TTL, 30)
+        response = jsonify({
+            'error': f'The server is low on disk space, please try again in {retry_after} seconds',
+            'retry_after': retry_after
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    active = download_queue.active()
+    if active + count <= MAX_ACTIVE:
+        return None
+
+    # Everything ahead runs in waves of WORKER_COUNT downloads
+    times = list(download_times)
+    average = sum(times) / len(times) if times else 0
+    retry_after = int(max((active + count - MAX_ACTIVE) / max(WORKER_COUNT, 1) * average, average, 10))
+    response = jsonify({
+        'error': f'Too many downloads are in progress, please try again in {retry_after} seconds',
+        'retry_after': retry_after,
+        'queue_position': active + 1
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
 
 @social_media_bp.route('/api/status/<download_id>')
 def get_status(download_id):
-    """Get download status"""
+    """Get download status; with ?since=<log_cursor> only log lines added after that cursor are returned"""
     if download_id not in downloads:
         return jsonify({'error': 'Download not found'}), 404
 
-    return jsonify(downloads[download_id])
+    info = download_record(download_id, downloads[download_id])
+    since = request.args.get('since', type=int)
+    if since is not None:
+        info['logs'] = logs_since(info['logs'], info.get('log_cursor', len(info['logs'])), since)
+    return jsonify(info)
 
 @social_media_bp.route('/api/download-file/<download_id>')
 def download_file(download_id):
     """Download the completed file"""
-    if download_id not in downloads:
+    download_info = downloads.get(download_id)
+    if download_info is None:
         return jsonify({'error': 'Download not found'}), 404
 
-    download_info = downloads[download_id]
-
     if download_info['status'] != 'completed' or not download_info['file']:
         return jsonify({'error': 'File not ready'}), 400
 
+    # Carousels are sent as one ZIP of all their files
+    if len(download_files(download_info)) > 1:
+        return archive_response([download_id], f'{download_id}.zip')
+
     file_path = os.path.join(DOWNLOAD_FOLDER, download_info['file'])
 
-    if not os.path.exists(file_path):
+    if not os.path.isfile(file_path):
         return jsonify({'error': 'File not found'}), 404
 
-    return send_file(file_path, as_attachment=True)
+    started = time.time()
+    response = serve_held(file_expiry, file_path, DOWNLOAD_FOLDER, ACCEL_REDIRECT_PREFIX)
+    stage_seconds.observe(time.time() - started, stage='serve')
+    # With X-Accel-Redirect nginx sends the body
+    served_bytes.inc(os.path.getsize(file_path) if X_ACCEL_REDIRECT else response.content_length or 0, kind='file')
+    return response
+
+def stream_archive(download_ids):
+    """
+    Generate a stored (uncompressed) ZIP of the files of several downloads.
+
+    Files are added as their downloads complete, so the archive starts streaming
+    while the rest are still running; it is finished once every download is, or
+    with the files sent so far after ARCHIVE_MAX_DURATION. Every download's files
+    are held (archive_holds) from the start until the stream ends, so none expires
+    while a slow client receives earlier ones. Memory use is one chunk regardless
+    of archive size.
+    """
+    sink = ZipStream()
+    pending = list(download_ids)
+    ready = []  # Published file names not yet added to the archive
+    started = time.time()
+    with archived_lock:
+        for download_id in download_ids:
+            archived_downloads[download_id] = archived_downloads.get(download_id, 0) + 1
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            while pending or ready:
+                if time.time() - started > ARCHIVE_MAX_DURATION:
+                    print(f"Archive stopped after {ARCHIVE_MAX_DURATION}s, {len(pending) + len(ready)} items left out")
+                    break
+                for download_id in list(pending):
+                    info = downloads.get(download_id)
+                    if info is not None and info['status'] not in FINISHED_STATUSES:
+                        continue
+                    pending.remove(download_id)
+                    if info is not None and info['status'] == 'completed':
+                        ready.extend(download_files(info))
+
+                if not ready:
+                    time.sleep(ARCHIVE_POLL_INTERVAL)
+                    continue
+
+                name = ready.pop(0)
+                file_path = os.path.join(DOWNLOAD_FOLDER, name)
+                if not os.path.isfile(file_path):
+                    continue
+                entry = zipfile.ZipInfo.from_file(file_path, arcname=name)
+                entry.compress_type = zipfile.ZIP_STORED
+                with open(file_path, 'rb') as source, archive.open(entry, 'w') as target:
+                    while True:
+                        chunk = source.read(ARCHIVE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield sink.take()
+                yield sink.take()
+        yield sink.take()
+    finally:
+        with archived_lock:
+            for download_id in download_ids:
+                archived_downloads[download_id] -= 1
+                if not archived_downloads[download_id]:
+                    del archived_downloads[download_id]
+
+def metrics():
+    """Metric families of this process as (name, type, help, samples), rendered by /metrics in main.py"""
+    ydl_stats = downloader_module.ydl_pool.stats()
+    return [
+        ('cub_queue_depth', 'gauge', 'Downloads waiting for a worker',
+         [('cub_queue_depth', {}, download_queue.qsize())]),
+        ('cub_active_workers', 'gauge', 'Download workers running a download',
+         [('cub_active_workers', {}, download_queue.busy_workers)]),
+        ('cub_worker_slots', 'gauge', 'Download workers',
+         [('cub_worker_slots', {}, WORKER_COUNT)]),
+        ('cub_active_streams', 'gauge', 'Posts being piped from the origin to a client',
+         [('cub_active_streams', {}, active_streams)]),
+        ('cub_stage_seconds', 'histogram', 'Time spent in each download stage',
+         stage_seconds.samples('cub_stage_seconds')),
+        ('cub_fetched_bytes_total', 'counter', 'Bytes fetched from the source platforms',
+         fetched_bytes.samples('cub_fetched_bytes_total')),
+        ('cub_served_bytes_total', 'counter', 'Bytes of finished files sent to clients',
+         served_bytes.samples('cub_served_bytes_total')),
+        ('cub_downloads_total', 'counter', 'Finished downloads by platform and status',
+         download_outcomes.samples('cub_downloads_total')),
+        ('cub_ydl_instances_total', 'counter', 'yt-dlp instances created or reused for a download',
+         [('cub_ydl_instances_total', {'result': 'created'}, ydl_stats['created']),
+          ('cub_ydl_instances_total', {'result': 'reused'}, ydl_stats['reused'])]),
+        ('cub_ydl_idle', 'gauge', 'Idle yt-dlp instances kept for reuse',
+         [('cub_ydl_idle', {}, ydl_stats['idle'])]),
+    ]
 
 @social_media_bp.route('/api/stats')
 def get_stats():
     """Get global download stats"""
     return jsonify({
-        'total_downloads': total_downloads
+        'total_downloads': total_download_count()
     })
 
 def detect_platform(url):
@@ -107,27 +823,59 @@ def detect_platform(url):
 
     return None
 
+def process_downloads():
+    """Background worker that runs queued downloads until the queue is closed"""
+    while True:
+        job = download_queue.get()
+        if job is None:
+            return
+        download_id, url, platform, queued_at = job
+        try:
+            process_download(download_id, url, platform)
+        except Exception as e:
+            print(f"Worker error: {e}")
+        finally:
+            download_queue.task_done(platform)
+
 def process_download(download_id, url, platform):
     """Process the download in background"""
+    # Download into a staging folder so partial files never show up in DOWNLOAD_FOLDER
+    staging_folder = os.path.join(TEMP_FOLDER, download_id)
+    os.makedirs(staging_folder, exist_ok=True)
+    started_at = time.time()
+    fetch_started = []
+
+    def on_fetch_start():
+        fetch_started.append(time.time())
+        stage_seconds.observe(fetch_started[0] - started_at, stage='extract')
+
     try:
         downloads[download_id]['status'] = 'downloading'
         downloads[download_id]['logs'].append(f'Starting {platform} download...')
 
-        # Import downloader using importlib
-        import importlib.util
-        downloader_path = os.path.join(APP_DIR, 'downloader.py')
-        spec = importlib.util.spec_from_file_location("downloader", downloader_path)
-        downloader_module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(downloader_module)
-
         # Download the content
-        file_path = downloader_module.download_content(url, platform, DOWNLOAD_FOLDER, download_id, downloads)
+        file_paths = downloader_module.download_content(url, platform, staging_folder, download_id, downloads,
+                                                        on_fetch_start=on_fetch_start)
+
+        if file_paths and all(os.path.exists(file_path) for file_path in file_paths):
+            if fetch_started:
+                stage_seconds.observe(time.time() - fetch_started[0], stage='fetch')
+            publish_started = time.time()
+            names = []
+            for file_path in file_paths:
+                fetched_bytes.inc(os.path.getsize(file_path), platform=platform)
+                published_path = os.path.join(DOWNLOAD_FOLDER, os.path.basename(file_path))
+                os.replace(file_path, published_path)
+                file_expiry.schedule(published_path)
+                names.append(os.path.basename(file_path))
+            stage_seconds.observe(time.time() - publish_started, stage='publish')
 
-        if file_path and os.path.exists(file_path):
+            downloads[download_id]['files'] = names
+            downloads[download_id]['file'] = names[0]
             downloads[download_id]['status'] = 'completed'
-            downloads[download_id]['file'] = os.path.basename(file_path)
             downloads[download_id]['progress'] = 100
             downloads[download_id]['logs'].append('Download completed!')
+            download_times.append(time.time() - started_at)
 
             # Increment global stats
             global total_downloads
@@ -140,23 +888,141 @@ def process_download(download_id, url, platform):
         downloads[download_id]['error'] = str(e)
         downloads[download_id]['logs'].append(f'Error: {str(e)}')
 
-def cleanup_old_files():
-    """Clean up files older than 30 seconds"""
+    download_outcomes.inc(platform=platform, status=downloads[download_id]['status'])
+    shutil.rmtree(staging_folder, ignore_errors=True)
+
+def clear_staging(keep=()):
+    """
+    Remove staging folders left by a previous run. Folders of downloads in `keep`
+    (unfinished, so the previous process may still be running them until
+    recover_downloads() takes them over) and recently used ones are left alone.
+    """
+    cutoff = time.time() - WORKER_TIMEOUT
+    for staging_name in os.listdir(TEMP_FOLDER):
+        path = os.path.join(TEMP_FOLDER, staging_name)
+        try:
+            if staging_name in keep or os.path.getmtime(path) > cutoff:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+def sync_state():
+    """
+    Background task that writes changed downloads to the state store, sends
+    heartbeats and restarts the downloads of a previous process once it is gone
+    (a reload starts the new process before the old one has exited).
+    """
+    global synced_total
+    written = {}  # download_id -> record last written
+    settled = {}  # Finished downloads whose final record has been written -> when
+    last_heartbeat = 0
     while True:
         try:
-            current_time = datetime.now()
-            for filename in os.listdir(DOWNLOAD_FOLDER):
-                file_path = os.path.join(DOWNLOAD_FOLDER, filename)
-                if os.path.isfile(file_path):
-                    file_age = current_time - datetime.fromtimestamp(os.path.getmtime(file_path))
-                    if file_age > timedelta(seconds=30):
-                        os.remove(file_path)
-                        print(f"Cleaned up old file: {filename}")
+            changed = []
+            for download_id, info in list(downloads.items()):
+                if download_id in settled:
+                    continue
+                record = download_record(download_id, info)
+                if written.get(download_id) != record:
+                    changed.append((download_id, record))
+                elif record['status'] in FINISHED_STATUSES:
+                    settled[download_id] = time.time()
+                    del written[download_id]
+            if changed:
+                state_store.save_downloads(worker_id, changed)
+                written.update(changed)
+
+            count = total_downloads - synced_total
+            if count:
+                state_store.add_total(count)
+                synced_total += count
+
+            if time.time() - last_heartbeat >= WORKER_HEARTBEAT:
+                last_heartbeat = time.time()
+                state_store.heartbeat(worker_id)
+                state_store.evict(STATE_TTL)
+                recover_downloads()
+
+                # Forget finished downloads once the state store has too
+                cutoff = time.time() - STATE_TTL
+                for download_id in [download_id for download_id, when in settled.items() if when < cutoff]:
+                    del settled[download_id]
+                    downloads.pop(download_id, None)
         except Exception as e:
-            print(f"Cleanup error: {e}")
+            print(f"State sync error: {e}")
+
+        time.sleep(STATE_SYNC_INTERVAL)  # Coalesce bursts of progress updates into one write
 
-        time.sleep(15)  # Run every 15 seconds
+def recover_downloads():
+    """Restart the unfinished downloads of a previous process that stopped, e.g. before a restart"""
+    for download_id, record in state_store.claim_orphans(worker_id, WORKER_TIMEOUT):
+        if download_id in downloads:
+            continue
+        # The previous process is gone, so its partial files can go
+        shutil.rmtree(os.path.join(TEMP_FOLDER, download_id), ignore_errors=True)
+        record.update({'status': 'queued', 'progress': 0, 'file': None, 'files': [], 'error': None})
+        record['logs'] = LogBuffer(record['logs'], record.get('log_cursor'))
+        record['logs'].append('Restarted after the server restarted')
+        downloads[download_id] = record
+        download_queue.put(download_id, record['url'], record['platform'])
+        print(f"Recovered download {download_id}")
+
+background_pid = None  # Process the background threads were started in
+background_lock = threading.Lock()
+worker_threads = []
+
+def start_background():
+    """
+    Start the cleanup and state sync threads of this process, once.
+
+    Threads don't survive a fork, so gunicorn workers call this after loading
+    the app (post_worker_init in gunicorn_config.py); requests call it too, in
+    case a process was forked without it.
+    """
+    global background_pid, worker_id
+    if background_pid == os.getpid():
+        return
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        background_pid = os.getpid()
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    try:
+        state_store.register(worker_id)
+        keep = state_store.unfinished_download_ids()
+    except Exception as e:
+        print(f"State store error: {e}")
+        keep = set()
+    clear_staging(keep)
+    file_expiry.load()
+    for worker_index in range(WORKER_COUNT):
+        worker_thread = threading.Thread(target=process_downloads, name=f'social-worker-{worker_index}', daemon=True)
+        worker_thread.start()
+        worker_threads.append(worker_thread)
+    threading.Thread(target=file_expiry.run, name='social-file-expiry', daemon=True).start()
+    threading.Thread(target=sync_state, name='social-state-sync', daemon=True).start()
+    atexit.register(stop_background)
+
+def stop_background():
+    """
+    Let running downloads finish (up to SHUTDOWN_TIMEOUT), then write the final
+    states, so the next start restarts what is still queued or unfinished.
+    """
+    download_queue.close()
+    deadline = time.time() + SHUTDOWN_TIMEOUT
+    for worker_thread in worker_threads:
+        worker_thread.join(max(0, deadline - time.time()))
+    downloader_module.ydl_pool.close()
+    try:
+        state_store.save_downloads(worker_id, [(download_id, download_record(download_id, info))
+                                               for download_id, info in list(downloads.items())
+                                               if info['status'] not in FINISHED_STATUSES])
+        state_store.unregister(worker_id)
+    except Exception as e:
+        print(f"State store error: {e}")
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-cleanup_thread.start()
+@social_media_bp.before_app_request
+def ensure_background():
+    start_background()
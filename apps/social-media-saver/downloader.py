@@ -1,8 +1,142 @@
 import yt_dlp
+from yt_dlp.networking import Request
 import os
+import threading
 from pathlib import Path
 
-def download_content(url, platform, download_folder, download_id, downloads_dict):
+YDL_MAX_USES = int(os.environ.get('SOCIAL_YDL_MAX_USES', '50'))  # Downloads before an instance is replaced
+PROGRESS_LOG_STEP = 10  # Percent between "Downloading..." log lines
+STREAM_PROTOCOLS = ('http', 'https')  # Formats that are one plain file at a URL, which can be piped through
+
+# Shared options; the output template and progress hook are set per download
+YDL_OPTS = {
+    'format': 'best',  # Download best quality
+    'quiet': False,
+    'no_warnings': False,
+    'restrictfilenames': True,  # Sanitize filenames to remove special characters
+}
+
+class PooledYoutubeDL:
+    """A long-lived YoutubeDL whose progress hook forwards to the current download"""
+    def __init__(self):
+        self.hook = None
+        self.uses = 0
+        self.ydl = yt_dlp.YoutubeDL(dict(YDL_OPTS, progress_hooks=[self.progress]))
+
+    def progress(self, d):
+        if self.hook:
+            self.hook(d)
+
+class YoutubeDLPool:
+    """
+    Idle YoutubeDL instances per platform. Reusing them keeps initialized
+    extractors, cookies and keep-alive connections to the platform's CDN
+    between downloads. Each instance is used by one download at a time.
+    """
+    def __init__(self, max_uses):
+        self.max_uses = max_uses
+        self.idle = {}  # platform -> [PooledYoutubeDL]
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, platform):
+        with self.lock:
+            idle = self.idle.get(platform)
+            if idle:
+                self.reused += 1
+                return idle.pop()
+            self.created += 1
+        return PooledYoutubeDL()
+
+    def release(self, platform, pooled, reusable=True):
+        """Return an instance after a download; broken or worn-out ones are closed instead"""
+        pooled.hook = None
+        pooled.uses += 1
+        if reusable and pooled.uses < self.max_uses:
+            with self.lock:
+                self.idle.setdefault(platform, []).append(pooled)
+                return
+        pooled.ydl.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for instances in idle.values():
+            for pooled in instances:
+                pooled.ydl.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'idle': sum(len(instances) for instances in self.idle.values())
+            }
+
+ydl_pool = YoutubeDLPool(YDL_MAX_USES)
+
+def resolve_stream(url, platform):
+    """
+    Look up the direct media URL of a single-file post, so its bytes can be
+    piped straight to the client.
+
+    Returns {'url', 'headers', 'cookies', 'ext', 'filesize'}, or None when the
+    post needs a normal download (carousels, formats that are fragmented or must
+    be merged). 'cookies' is the Cookie header, kept apart so it is never saved.
+    """
+    pooled = ydl_pool.acquire(platform)
+    reusable = False
+    try:
+        info = pooled.ydl.extract_info(url, download=False)
+        reusable = True
+
+        entries = [entry for entry in info.get('entries') or [info] if entry]
+        if len(entries) != 1:
+            return None
+        info = entries[0]
+        if info.get('requested_formats') or info.get('protocol') not in STREAM_PROTOCOLS or not info.get('url'):
+            return None
+
+        # The CDN may want the cookies set while extracting (TikTok does)
+        headers = {key: value for key, value in (info.get('http_headers') or {}).items() if key.lower() != 'cookie'}
+        return {
+            'url': info['url'],
+            'headers': headers,
+            'cookies': pooled.ydl.cookiejar.get_cookie_header(info['url']) or None,
+            'ext': info.get('ext') or 'mp4',
+            'filesize': info.get('filesize') or info.get('filesize_approx')
+        }
+    finally:
+        ydl_pool.release(platform, pooled, reusable)
+
+class MediaStream:
+    """Origin response for a resolved stream, opened through a pooled YoutubeDL (its connections and proxy settings)"""
+    def __init__(self, media, platform):
+        self.platform = platform
+        headers = dict(media['headers'])
+        if media.get('cookies'):
+            headers['Cookie'] = media['cookies']
+        self.pooled = ydl_pool.acquire(platform)
+        try:
+            self.response = self.pooled.ydl.urlopen(Request(media['url'], headers=headers))
+        except Exception:
+            ydl_pool.release(platform, self.pooled, False)
+            raise
+        self.headers = self.response.headers
+        self.closed = False
+
+    def read(self, size):
+        return self.response.read(size)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.response.close()
+        ydl_pool.release(self.platform, self.pooled)
+
+def download_content(url, platform, download_folder, download_id, downloads_dict, on_fetch_start=None):
     """
     Download content from Instagram, TikTok, or Twitter
 
@@ -12,60 +146,70 @@ def download_content(url, platform, download_folder, download_id, downloads_dict
         download_folder: Where to save the file
         download_id: Unique ID for this download
         downloads_dict: Dictionary to update with progress
+        on_fetch_start: Called once when the media info is extracted and fetching starts
 
     Returns:
-        Path to the downloaded file
+        Paths of the downloaded files (one per entry for carousels and threads)
     """
 
+    fetch_started = []
+    logged_progress = [-PROGRESS_LOG_STEP]
+
     def progress_hook(d):
-        """Update progress during download"""
+        """Update progress during download, logging only every PROGRESS_LOG_STEP percent"""
+        if on_fetch_start and not fetch_started:
+            fetch_started.append(True)
+            on_fetch_start()
         if d['status'] == 'downloading':
-            if 'total_bytes' in d and d['total_bytes'] > 0:
+            if d.get('total_bytes'):
                 progress = int((d['downloaded_bytes'] / d['total_bytes']) * 100)
+                if progress == downloads_dict[download_id]['progress']:
+                    return
                 downloads_dict[download_id]['progress'] = progress
-                downloads_dict[download_id]['logs'].append(f'Downloading... {progress}%')
+                if progress - logged_progress[0] >= PROGRESS_LOG_STEP:
+                    logged_progress[0] = progress - progress % PROGRESS_LOG_STEP
+                    downloads_dict[download_id]['logs'].append(f'Downloading... {progress}%')
         elif d['status'] == 'finished':
+            logged_progress[0] = -PROGRESS_LOG_STEP  # The next carousel entry starts from 0%
             downloads_dict[download_id]['logs'].append('Processing file...')
 
-    # Configure yt-dlp options
-    ydl_opts = {
-        'format': 'best',  # Download best quality
-        'outtmpl': os.path.join(download_folder, f'{download_id}.%(ext)s'),
-        'progress_hooks': [progress_hook],
-        'quiet': False,
-        'no_warnings': False,
-        'restrictfilenames': True,  # Sanitize filenames to remove special characters
-    }
-
-    # Platform-specific settings
+    # Platform-specific messages (every platform downloads the best quality media)
     if platform == 'instagram':
         downloads_dict[download_id]['logs'].append('Fetching Instagram content...')
-        # Instagram: Download the best quality photo/video
-        ydl_opts['format'] = 'best'
 
     elif platform == 'tiktok':
         downloads_dict[download_id]['logs'].append('Fetching TikTok video...')
-        # TikTok: Try to get version without watermark
-        ydl_opts['format'] = 'best'
 
     elif platform == 'twitter':
         downloads_dict[download_id]['logs'].append('Fetching Twitter/X media...')
-        # Twitter: Download best quality media
-        ydl_opts['format'] = 'best'
 
+    pooled = ydl_pool.acquire(platform)
+    pooled.hook = progress_hook
+    ydl = pooled.ydl
+    # Entries of a carousel (a playlist to yt-dlp) are numbered: <id>_1.jpg, <id>_2.mp4, ...
+    ydl.params['outtmpl']['default'] = os.path.join(download_folder, f'{download_id}%(playlist_index&_{{}}|)s.%(ext)s')
+    reusable = False
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # Extract info to get the filename
-            info = ydl.extract_info(url, download=True)
+        # Extract info to get the filenames
+        info = ydl.extract_info(url, download=True)
+        reusable = True
 
-            # Get the actual filename
-            filename = ydl.prepare_filename(info)
+        # Get the actual filenames
+        filenames = []
+        for entry in info.get('entries') or [info]:
+            if not entry:
+                continue
+            requested = entry.get('requested_downloads') or [{}]
+            filename = requested[0].get('filepath') or ydl.prepare_filename(entry)
+            if os.path.exists(filename) and filename not in filenames:
+                filenames.append(filename)
 
-            if os.path.exists(filename):
+        if filenames:
+            for filename in filenames:
                 downloads_dict[download_id]['logs'].append(f'Downloaded: {Path(filename).name}')
-                return filename
-            else:
-                raise Exception('File was not created')
+            return filenames
+        else:
+            raise Exception('File was not created')
 
     except Exception as e:
         error_msg = str(e)
@@ -78,3 +222,6 @@ def download_content(url, platform, download_folder, download_id, downloads_dict
 
         downloads_dict[download_id]['logs'].append(f'Error: {error_msg}')
         raise Exception(f'Failed to download from {platform}: {error_msg}')
+
+    finally:
+        ydl_pool.release(platform, pooled, reusable)
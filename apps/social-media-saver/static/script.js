@@ -1,5 +1,7 @@
 let activeDownloads = new Set();
 let pollingIntervals = new Map();
+let logCursors = new Map();  // download id -> log_cursor of the last status received
+const STREAM_START_TIMEOUT = 30000;  // Milliseconds the hidden frame gets to start a stream
 
 function startDownload() {
     const urlInput = document.getElementById('urlInput');
@@ -15,14 +17,21 @@ function startDownload() {
         return;
     }
 
+    // Several pasted links are downloaded together and saved as one ZIP
+    const urls = url.split(/\s+/);
+    if (urls.length > 1) {
+        startBatch(urls);
+        return;
+    }
+
     // Disable button and show loader
     downloadBtn.disabled = true;
     btnText.style.display = 'none';
     btnLoader.style.display = 'block';
     errorMessage.classList.remove('show');
 
-    // Send download request
-    fetch('/apps/social-media-saver/api/download', {
+    // Single-file posts are piped straight from the source; others come back as a queued download
+    fetch('/apps/social-media-saver/api/stream', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
@@ -41,6 +50,11 @@ function startDownload() {
         urlInput.value = '';
         resetButton();
 
+        if (data.mode === 'stream') {
+            startStream(data.stream_token, url, data.platform);
+            return;
+        }
+
         // Add download to active downloads
         activeDownloads.add(data.download_id);
         createDownloadCard(data.download_id, url, data.platform);
@@ -54,6 +68,170 @@ function startDownload() {
     });
 }
 
+function startStream(token, url, platform) {
+    const streamUrl = `/apps/social-media-saver/api/stream/${token}`;
+    createDownloadCard(token, url, platform);
+    updateDownloadCard(token, {
+        status: 'downloading',
+        progress: 0,
+        logs: ['Connecting to the source...']
+    });
+
+    // Check the token and a free slot first: an error page in the hidden frame would never be seen
+    fetch(streamUrl, { method: 'HEAD' })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(streamErrorMessage(response.status));
+        }
+        updateDownloadCard(token, {
+            status: 'downloading',
+            progress: 0,
+            logs: ['Streaming straight from the source...']
+        });
+        triggerFrameDownload(streamUrl);
+        pollStream(token);
+    })
+    .catch(error => failStream(token, error.message));
+}
+
+// Follow a stream the hidden frame is saving, until the server has sent all of it
+function pollStream(token) {
+    const started = Date.now();
+    const interval = setInterval(() => {
+        fetch(`/apps/social-media-saver/api/stream/${token}/status`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(streamErrorMessage(response.status));
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (data.status === 'completed') {
+                    clearInterval(interval);
+                    pollingIntervals.delete(token);
+                    updateDownloadCard(token, {
+                        status: 'completed',
+                        progress: 100,
+                        logs: ['Saved straight from the source']
+                    });
+                } else if (data.status === 'failed') {
+                    throw new Error('The source stopped sending the file, please try again');
+                } else if (data.status === 'ready' && Date.now() - started > STREAM_START_TIMEOUT) {
+                    throw new Error('The download did not start, please try again');
+                } else if (data.status === 'streaming') {
+                    updateDownloadCard(token, {
+                        status: 'downloading',
+                        progress: data.filesize ? Math.min(99, Math.round(data.sent / data.filesize * 100)) : 0
+                    });
+                }
+            })
+            .catch(error => {
+                clearInterval(interval);
+                pollingIntervals.delete(token);
+                failStream(token, error.message);
+            });
+    }, 1000);
+
+    pollingIntervals.set(token, interval);
+}
+
+function failStream(token, message) {
+    updateDownloadCard(token, {
+        status: 'failed',
+        progress: 0,
+        logs: [],
+        error: message
+    });
+    showError(message);
+}
+
+function streamErrorMessage(status) {
+    if (status === 404) {
+        return 'The stream has expired, please try again';
+    }
+    if (status === 502) {
+        return 'Could not reach the source, please try again';
+    }
+    if (status === 429 || status === 503) {
+        return 'The server is busy, please try again in a moment';
+    }
+    return `Streaming failed (HTTP ${status})`;
+}
+
+function startBatch(urls) {
+    const urlInput = document.getElementById('urlInput');
+    const downloadBtn = document.getElementById('downloadBtn');
+    const btnText = document.getElementById('btnText');
+    const btnLoader = document.getElementById('btnLoader');
+    const errorMessage = document.getElementById('errorMessage');
+
+    downloadBtn.disabled = true;
+    btnText.style.display = 'none';
+    btnLoader.style.display = 'block';
+    errorMessage.classList.remove('show');
+
+    fetch('/apps/social-media-saver/api/batch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ urls: urls })
+    })
+    .then(response => response.json())
+    .then(data => {
+        resetButton();
+        if (data.error) {
+            showError(data.error);
+            return;
+        }
+
+        urlInput.value = '';
+        if (data.rejected.length) {
+            showError(`Skipped unsupported URLs: ${data.rejected.map(item => item.url).join(', ')}`);
+        }
+
+        data.downloads.forEach(download => {
+            activeDownloads.add(download.download_id);
+            createDownloadCard(download.download_id, download.url, download.platform);
+            startPolling(download.download_id, true);
+        });
+        pollBatch(data.batch_id);
+    })
+    .catch(error => {
+        showError('Failed to start downloads: ' + error.message);
+        resetButton();
+    });
+}
+
+// Start the batch's ZIP once its first download completes; it streams the rest as they finish
+function pollBatch(batchId) {
+    let archiveStarted = false;
+    const interval = setInterval(() => {
+        fetch(`/apps/social-media-saver/api/batch/${batchId}`)
+            .then(response => {
+                if (!response.ok) {
+                    if (response.status === 404) {
+                        clearInterval(interval);
+                    }
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                if (!archiveStarted && data.downloads.some(download => download.status === 'completed')) {
+                    archiveStarted = true;
+                    triggerFrameDownload(`/apps/social-media-saver/api/batch/${batchId}/archive`);
+                }
+                if (data.finished) {
+                    clearInterval(interval);
+                }
+            })
+            .catch(error => {
+                console.error('Batch polling error:', error);
+            });
+    }, 1000);
+}
+
 function createDownloadCard(downloadId, url, platform) {
     const container = document.getElementById('activeDownloads');
 
@@ -85,9 +263,12 @@ function createDownloadCard(downloadId, url, platform) {
     container.prepend(card);
 }
 
-function startPolling(downloadId) {
+// Downloads of a batch are saved in the batch's ZIP instead of one by one
+function startPolling(downloadId, inBatch = false) {
     const interval = setInterval(() => {
-        fetch(`/apps/social-media-saver/api/status/${downloadId}`)
+        // Only ask for log lines added since the last poll
+        const since = logCursors.has(downloadId) ? `?since=${logCursors.get(downloadId)}` : '';
+        fetch(`/apps/social-media-saver/api/status/${downloadId}${since}`)
             .then(response => {
                 if (!response.ok) {
                     if (response.status === 404) {
@@ -105,8 +286,9 @@ function startPolling(downloadId) {
                 if (data.status === 'completed' || data.status === 'failed') {
                     clearInterval(interval);
                     pollingIntervals.delete(downloadId);
+                    logCursors.delete(downloadId);
 
-                    if (data.status === 'completed') {
+                    if (data.status === 'completed' && !inBatch) {
                         triggerDownload(downloadId);
                     }
                 }
@@ -135,13 +317,21 @@ function updateDownloadCard(downloadId, data) {
         progressBar.style.width = `${data.progress}%`;
     }
 
-    // Update logs
+    // Update logs: the first status replaces the placeholder, later ones only carry new lines
     if (logsSection && data.logs) {
-        logsSection.innerHTML = data.logs.map(log =>
+        const lines = data.logs.map(log =>
             `<div class="log-line">${log}</div>`
         ).join('');
+        if (logCursors.has(downloadId)) {
+            logsSection.insertAdjacentHTML('beforeend', lines);
+        } else {
+            logsSection.innerHTML = lines;
+        }
         logsSection.scrollTop = logsSection.scrollHeight;
     }
+    if (data.log_cursor !== undefined) {
+        logCursors.set(downloadId, data.log_cursor);
+    }
 
     // Handle errors
     if (data.error && data.status === 'failed') {
@@ -152,8 +342,10 @@ function updateDownloadCard(downloadId, data) {
 }
 
 function triggerDownload(downloadId) {
-    const downloadUrl = `/apps/social-media-saver/api/download-file/${downloadId}`;
+    triggerFrameDownload(`/apps/social-media-saver/api/download-file/${downloadId}`);
+}
 
+function triggerFrameDownload(downloadUrl) {
     // Create hidden iframe to trigger download
     const iframe = document.createElement('iframe');
     iframe.style.display = 'none';
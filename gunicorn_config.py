@@ -5,11 +5,14 @@ bind = "127.0.0.1:3000"
 backlog = 2048
 
 # Worker processes
-# Use 1 worker to maintain shared state (active_downloads dictionary)
-# Use threads for concurrency instead of multiple workers
+# Keep one: the download queues, file expiry, result/source/info caches and their
+# size caps live in the process. A second worker would delete files the first is
+# still sending and double every cap. Task state in SQLite survives restarts.
 workers = 1
 worker_class = 'gthread'
-threads = 4
+# Status streams, ZIP archives and piped posts hold a thread while they are open;
+# at most CUB_LONG_RESPONSE_SLOTS (default 10) of them, see shared/responses.py
+threads = 16
 worker_connections = 1000
 timeout = 300
 keepalive = 2
@@ -34,3 +37,9 @@ tmp_upload_dir = None
 # SSL (if needed)
 # keyfile = '/path/to/keyfile'
 # certfile = '/path/to/certfile'
+
+# Server hooks
+def post_worker_init(worker):
+    """Start the apps' background threads in each worker, after the fork"""
+    import main
+    main.start_background()
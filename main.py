@@ -1,9 +1,12 @@
-from flask import Flask, send_from_directory, render_template
+from flask import Flask, Response, send_from_directory, render_template, request, g
 import socket
 import os
 import sys
+import time
 import importlib.util
 from jinja2 import ChoiceLoader, FileSystemLoader
+from shared.metrics import Counter, Histogram
+from shared.responses import long_responses
 
 # Create the main Flask app with multiple template folders
 app = Flask(__name__,
@@ -67,18 +70,79 @@ def get_combined_stats():
 
     # Get music downloader stats
     try:
-        total += music_module.total_downloads
+        total += music_module.total_download_count()
     except:
         pass
 
     # Get social media saver stats
     try:
-        total += social_module.total_downloads
+        total += social_module.total_download_count()
     except:
         pass
 
     return jsonify({'total_downloads': total})
 
+# ==================== METRICS ====================
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+request_latency = Histogram(HTTP_BUCKETS)  # By route and method
+request_counts = Counter()  # By route, method and status
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # The route pattern, not the path, so task IDs don't create new series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.observe(time.perf_counter() - started, route=route, method=request.method)
+        request_counts.inc(route=route, method=request.method, status=str(response.status_code))
+    return response
+
+def collect_metrics():
+    """Metric families of this process, with each app's samples labelled by app"""
+    families = [
+        ('cub_http_request_duration_seconds', 'histogram',
+         'Time to produce a response (streamed bodies are sent afterwards)',
+         request_latency.samples('cub_http_request_duration_seconds')),
+        ('cub_http_requests_total', 'counter', 'Requests by route, method and status',
+         request_counts.samples('cub_http_requests_total')),
+        ('cub_long_responses', 'gauge', 'Streamed responses holding a server thread (events, archives, streams)',
+         [('cub_long_responses', {}, long_responses.active)]),
+        ('cub_long_responses_refused_total', 'counter', 'Streamed responses refused with 503 because every slot was taken',
+         [('cub_long_responses_refused_total', {}, long_responses.refused)]),
+    ]
+    for app_name, module in (('music-downloader', music_module), ('social-media-saver', social_module)):
+        try:
+            for name, kind, help_text, samples in module.metrics():
+                families.append((name, kind, help_text,
+                                 [(sample, dict(labels, app=app_name), value) for sample, labels, value in samples]))
+        except Exception as e:
+            print(f"Metrics error ({app_name}): {e}")
+    return families
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of queue, pipeline stage, cache and HTTP metrics"""
+    lines = []
+    for name, kind, help_text, samples in collect_metrics():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            lines.append(f"{sample}{format_labels(labels)} {value}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 # ==================== MUSIC DOWNLOADER APP INTEGRATION ====================
 
 # Load Music Downloader blueprint using importlib
@@ -99,6 +163,11 @@ app.register_blueprint(social_module.social_media_bp, url_prefix='/apps/social-m
 
 # ==================== SERVER STARTUP ====================
 
+def start_background():
+    """Start the apps' worker and cleanup threads in this process (see gunicorn_config.py)"""
+    music_module.start_background()
+    social_module.start_background()
+
 if __name__ == '__main__':
     # Get local IP
     try:
@@ -133,4 +202,5 @@ if __name__ == '__main__':
     print()
 
     # Run the server
+    start_background()
     app.run(host='0.0.0.0', port=3000, debug=False, threaded=True)
@@ -0,0 +1 @@
+"""Code shared by the apps' blueprints, imported from the repository root"""
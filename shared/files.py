@@ -0,0 +1,216 @@
+"""Expiry, serving and archiving of the apps' finished files"""
+import os
+import io
+import time
+import heapq
+import mimetypes
+import threading
+from urllib.parse import quote
+from flask import Response, send_file
+
+# With CUB_X_ACCEL_REDIRECT=1 nginx sends finished files (see the /_protected/ locations in nginx.conf)
+X_ACCEL_REDIRECT = os.environ.get('CUB_X_ACCEL_REDIRECT') == '1'
+
+class ExpiryScheduler:
+    """
+    Deletes published files when they expire, without scanning the download folder.
+
+    Every file gets a deadline in a heap and one thread sleeps until the earliest
+    one is due. A file is deferred by another `ttl` instead of deleted while it
+    (or its folder) is in use, see acquire()/release(), or while `is_busy(path)`
+    says its task is still running.
+    """
+    def __init__(self, root, ttl, is_busy=None):
+        self.root = root
+        self.ttl = ttl
+        self.is_busy = is_busy
+        self.heap = []  # (deadline, path), may hold stale entries for rescheduled paths
+        self.deadlines = {}  # path -> current deadline
+        self.in_use = {}  # path -> reference count
+        self.deleted = 0
+        self.deferred = 0
+        self.condition = threading.Condition()
+
+    def schedule(self, path, delay=None):
+        """Delete a file `delay` seconds from now (default ttl), replacing any earlier deadline"""
+        deadline = time.time() + (self.ttl if delay is None else delay)
+        with self.condition:
+            self.deadlines[path] = deadline
+            heapq.heappush(self.heap, (deadline, path))
+            self.condition.notify()
+
+    def acquire(self, path):
+        """Keep a file, or every file in a folder, until the matching release()"""
+        with self.condition:
+            self.in_use[path] = self.in_use.get(path, 0) + 1
+
+    def release(self, path):
+        with self.condition:
+            self.in_use[path] -= 1
+            if not self.in_use[path]:
+                del self.in_use[path]
+
+    def _in_use(self, path):
+        """Whether the file or its folder is acquired; call with the lock held"""
+        return path in self.in_use or os.path.dirname(path) in self.in_use
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                deadline, path = heapq.heappop(self.heap)
+                if self.deadlines.get(path) != deadline:
+                    continue  # Rescheduled since
+                busy = self._in_use(path)
+            # is_busy may query the state database, so it runs without holding the lock
+            busy = busy or bool(self.is_busy and self.is_busy(path))
+            with self.condition:
+                if self.deadlines.get(path) != deadline:
+                    continue  # Rescheduled meanwhile
+                if busy or self._in_use(path):
+                    self.deferred += 1
+                    self.deadlines[path] = time.time() + self.ttl
+                    heapq.heappush(self.heap, (self.deadlines[path], path))
+                    continue
+                del self.deadlines[path]
+            self._delete(path)
+
+    def _delete(self, path):
+        try:
+            os.remove(path)
+            self.deleted += 1
+            print(f"Cleaned up old file: {os.path.basename(path)}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error cleaning up {os.path.basename(path)}: {e}")
+
+        # Remove the task folder once its last file is gone
+        folder = os.path.dirname(path)
+        if folder != self.root:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+
+    def load(self):
+        """Schedule files left by a previous run (the only time the folder is scanned)"""
+        now = time.time()
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    self.schedule(path, max(0, os.path.getmtime(path) + self.ttl - now))
+                except OSError:
+                    pass
+            if not dirs and not files and root != self.root:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.condition:
+            return {
+                'scheduled': len(self.deadlines),
+                'in_use': sum(self.in_use.values()),
+                'deleted': self.deleted,
+                'deferred': self.deferred,
+                'next_in_seconds': round(max(0, self.heap[0][0] - time.time()), 1) if self.heap else None,
+            }
+
+def attachment_header(filename):
+    """Content-Disposition value for a download, with a UTF-8 name for non-ASCII titles"""
+    ascii_name = filename.encode('ascii', 'ignore').decode().replace('"', '').strip() or 'download'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+def serve_download(file_path, root, accel_prefix):
+    """
+    Send a published file from `root`.
+
+    With X_ACCEL_REDIRECT nginx transfers the file (sendfile, Range, ETag) from
+    `accel_prefix` and the gunicorn thread is free immediately. Otherwise Flask
+    answers Range and If-None-Match requests itself and hands full responses to
+    the server's sendfile-backed file wrapper.
+    """
+    if X_ACCEL_REDIRECT:
+        rel_path = os.path.relpath(file_path, root).replace(os.sep, '/')
+        response = Response(mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_prefix + quote(rel_path)
+        response.headers['Content-Disposition'] = attachment_header(os.path.basename(file_path))
+        return response
+    return send_file(file_path, as_attachment=True, conditional=True, etag=True)
+
+def serve_held(expiry, file_path, root, accel_prefix):
+    """
+    serve_download() with the file held by `expiry` until the response is closed,
+    then given a full ttl again, so repeated or resumed (Range) requests find it.
+
+    With X_ACCEL_REDIRECT nginx opens the file only after this response has been
+    closed, so the renewed ttl is then its only protection.
+    """
+    expiry.acquire(file_path)
+    try:
+        response = serve_download(file_path, root, accel_prefix)
+    except Exception:
+        expiry.release(file_path)
+        raise
+
+    released = []
+    def release():
+        if not released:
+            released.append(True)
+            expiry.release(file_path)
+
+    response.call_on_close(release)
+    # send_file bodies go straight to the server's file wrapper, which never calls the
+    # response's close callbacks, so release when the server closes the body itself
+    body = response.response
+    if response.direct_passthrough and hasattr(body, 'close'):
+        close = body.close
+        def close_body():
+            try:
+                close()
+            finally:
+                release()
+        body.close = close_body
+    expiry.schedule(file_path)
+    return response
+
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+
+class ZipStream(io.RawIOBase):
+    """Unseekable sink that zipfile writes into while the bytes are streamed out"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        """Return and forget everything written so far"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def count_served(chunks, served_bytes, stage_seconds):
+    """Pass a streamed archive through, recording its bytes and how long it took to send"""
+    started = time.time()
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        served_bytes.inc(sent, kind='archive')
+        stage_seconds.observe(time.time() - started, stage='serve')
@@ -0,0 +1,50 @@
+"""Metric primitives, rendered in Prometheus text format by /metrics in main.py"""
+import threading
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)  # Seconds
+
+class Counter:
+    """Prometheus-style counter with one value per label set"""
+    def __init__(self):
+        self.values = {}  # sorted label items -> value
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, name):
+        with self.lock:
+            return [(name, dict(key), value) for key, value in self.values.items()]
+
+class Histogram:
+    """Prometheus-style histogram: cumulative bucket counts, sum and count per label set"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # sorted label items -> [count per bucket..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self, name):
+        with self.lock:
+            items = [(dict(key), list(series)) for key, series in self.series.items()]
+        samples = []
+        for labels, series in items:
+            for bound, count in zip(self.buckets, series):
+                samples.append((f"{name}_bucket", dict(labels, le=str(bound)), count))
+            samples.append((f"{name}_bucket", dict(labels, le='+Inf'), series[-1]))
+            samples.append((f"{name}_sum", labels, round(series[-2], 6)))
+            samples.append((f"{name}_count", labels, series[-1]))
+        return samples
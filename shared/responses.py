@@ -0,0 +1,44 @@
+"""A process-wide limit on responses that hold a gunicorn thread while they stream"""
+import os
+import threading
+from flask import jsonify
+
+# Event streams, ZIP archives and piped posts each keep one of gunicorn_config.py's
+# 16 threads until they end; the rest stay free for ordinary requests
+LONG_RESPONSE_SLOTS = int(os.environ.get('CUB_LONG_RESPONSE_SLOTS', '10'))
+BUSY_RETRY_AFTER = 5  # Seconds clients are told to wait when every slot is taken
+
+class ResponseSlots:
+    """Counts long-lived responses of both apps; acquire() fails instead of waiting"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.active >= self.limit:
+                self.refused += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def available(self):
+        return self.active < self.limit
+
+long_responses = ResponseSlots(LONG_RESPONSE_SLOTS)
+
+def busy_response():
+    """503 with Retry-After for a long-lived response that found no free slot"""
+    response = jsonify({
+        'error': 'The server is busy, please try again in a moment',
+        'retry_after': BUSY_RETRY_AFTER
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(BUSY_RETRY_AFTER)
+    return response
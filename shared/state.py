@@ -0,0 +1,91 @@
+"""Bases for the apps' state backends: task state that survives a restart"""
+import os
+import time
+import sqlite3
+import threading
+
+# Databases written at runtime (state, metrics), kept out of the source tree
+DATA_DIR = os.environ.get('CUB_DATA_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'var'))
+
+class MemoryStore:
+    """
+    State kept only in this process, so nothing survives a restart. Subclasses
+    add no-op versions of their app's methods.
+    """
+
+    def __init__(self):
+        self.total_count = 0
+        self.lock = threading.Lock()
+
+    def register(self, worker_id):
+        pass
+
+    def heartbeat(self, worker_id):
+        pass
+
+    def unregister(self, worker_id):
+        pass
+
+    def add_total(self, count):
+        with self.lock:
+            self.total_count += count
+
+    def total(self):
+        return self.total_count
+
+class SQLiteStore:
+    """
+    A SQLite database (WAL mode) with process heartbeats and counters. Subclasses
+    add their app's tables in SCHEMA.
+
+    Each process sends a heartbeat; jobs of a process whose heartbeat stopped
+    (crash, restart) are claimed by the next one, so they are not lost. During a
+    reload the old process is still running, so its jobs wait until it is gone.
+    """
+    SCHEMA = ''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connect().executescript(self.SCHEMA + """
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+
+    def _connect(self):
+        """One connection per thread, never reused across a fork"""
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def register(self, worker_id):
+        self.heartbeat(worker_id)
+
+    def heartbeat(self, worker_id):
+        self._connect().execute('INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)',
+                                (worker_id, time.time()))
+
+    def unregister(self, worker_id):
+        """Mark a process gone, so its unfinished jobs are taken over right away"""
+        self._connect().execute('DELETE FROM workers WHERE worker_id = ?', (worker_id,))
+
+    def add_total(self, count):
+        self._connect().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', ('total_downloads', count))
+
+    def total(self):
+        row = self._connect().execute("SELECT value FROM counters WHERE name = 'total_downloads'").fetchone()
+        return row[0] if row else 0